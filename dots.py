@@ -1,9 +1,7 @@
 #!/usr/bin/env python3
 
 from abc import ABC, abstractmethod
-import json
 import os
-import re
 import stat
 import sys
 
@@ -15,6 +13,24 @@ class Default:
     # The default build directory.
     BUILD_DIR = "build"
 
+    # The default name of the manifest file in the build directory.
+    BUILD_MANIFEST = ".dots-manifest.json"
+
+    # The default name of the variable dependency index in the build
+    # directory.
+    BUILD_INDEX = ".dots-index.json"
+
+    # The default name of the directory of the rendered template store in the
+    # build directory.
+    BUILD_STORE = ".dots-store"
+
+    # The default maximum size in bytes of the store after it is collected.
+    STORE_MAX_SIZE = 256 << 20
+
+    # The default age in days after which unused objects are collected from
+    # the store.
+    STORE_MAX_AGE = 30
+
     # The default format enabled.
     BUILD_FORMAT = True
 
@@ -24,18 +40,46 @@ class Default:
     # The default file executable setting.
     FILE_EXECUTABLE = False
 
+    # The default file link setting, which inherits the package setting.
+    FILE_LINK = None
+
     # The default file template setting.
     FILE_TEMPLATE = False
 
     # The default for whether a template include is optional.
     INCLUDE_OPTIONAL = False
 
+    # The default package link setting.
+    PACKAGE_LINK = "copy"
+
+    # The default size in bytes of the chunks files are read in.
+    CHUNK_SIZE = 1 << 16
+
+    # The default size in bytes above which templates are rendered while they
+    # are read instead of being loaded into memory.
+    TEMPLATE_STREAM_SIZE = 1 << 20
+
+    # The default size in bytes above which a dry run does not show the diff
+    # of a file, so large files are never loaded into memory.
+    DIFF_SIZE = 1 << 20
+
     # The default template interpolation beginning token.
     TEMPLATE_BEGIN = "{{{"
 
     # The default template interpolation ending token.
     TEMPLATE_END = r"}}}"
 
+    # The default interval in seconds between checks for changes when watching
+    # files without inotify.
+    WATCH_INTERVAL = 1.0
+
+    # The default maximum time in seconds that importing the program should
+    # take, which is checked by `--startup-time`.
+    STARTUP_BUDGET = 0.02
+
+    # The default evaluator of template expressions.
+    TEMPLATE_EVALUATOR = "restricted"
+
     # The default template snippets directory.
     TEMPLATE_SNIPPETS = r"snippets"
 
@@ -126,7 +170,55 @@ class Title:
     BUILD     = "Build"
     EXCEPTION = "Exception"
     FORMAT    = "Format"
+    GC        = "GC"
     INSTALL   = "Install"
+    PLAN      = "Plan"
+    PROFILE   = "Profile"
+    STARTUP   = "Startup"
+    WATCH     = "Watch"
+
+class Link:
+    """
+    Strategies for installing files.
+    """
+    COPY     = "copy"
+    HARDLINK = "hardlink"
+    SYMLINK  = "symlink"
+
+    ALL = [COPY, HARDLINK, SYMLINK]
+
+class Evaluator:
+    """
+    Ways of evaluating template expressions.
+    """
+    # Only a small safe subset of Python is allowed
+    RESTRICTED = "restricted"
+    # Expressions are evaluated by `eval` with the full builtins
+    EVAL       = "eval"
+
+    ALL = [RESTRICTED, EVAL]
+
+class Engine:
+    """
+    Ways of running the files of a build or install concurrently.
+    """
+    # A pool of threads processes each file
+    THREADS = "threads"
+    # An event loop schedules each file on the same pool of threads
+    ASYNCIO = "asyncio"
+
+    ALL = [THREADS, ASYNCIO]
+
+class Plan:
+    """
+    The changes a dry run finds that a file operation would make.
+    """
+    CREATE    = "create"
+    UPDATE    = "update"
+    CHMOD     = "chmod-only"
+    UNCHANGED = "unchanged"
+
+    ALL = [CREATE, UPDATE, CHMOD, UNCHANGED]
 
 class DotsError(Exception):
     """
@@ -213,10 +305,133 @@ def safe_to_json(data, minify=True):
     else:
         raise JSONError(f"cannot interpret data of type {type(data)}")
 
+class PathExpander:
+    """
+    Expands paths against a snapshot of the environment taken when it is
+    created, so every path in a run is expanded the same way. The expanded
+    paths are memoized by the path before expansion.
+    """
+
+    def __init__(self, environ=None):
+        """
+        Create a new path expander.
+
+        # Arguments
+
+        * environ (dict<str, str>): The environment variables, or `None` to
+          take a snapshot of the environment of the process.
+        """
+        self.environ = dict(os.environ if environ is None else environ)
+        self._pattern = None
+        self._memo = {}
+
+    @property
+    def pattern(self):
+        """
+        The regular expression matching an environment variable, which is
+        compiled the first time it is used.
+        """
+        if self._pattern is None:
+            import re
+            self._pattern = re.compile(r"\$([A-Za-z_][A-Za-z0-9_]*|\{([A-Za-z_][A-Za-z0-9_]*)\})")
+        return self._pattern
+
+    def _expand(self, p, undefined):
+        ep = p
+        if ep == "~" or ep.startswith("~/"):
+            home = self.environ.get("HOME")
+            ep = home + ep[1:] if home else os.path.expanduser(ep)
+        elif ep.startswith("~"):
+            ep = os.path.expanduser(ep)
+
+        def variable(m):
+            name = m.group(2) or m.group(1)
+            value = self.environ.get(name)
+            if value is None:
+                undefined.append(name)
+                return m.group(0)
+            return value
+
+        return os.path.abspath(self.pattern.sub(variable, ep))
+
+    def expand(self, p):
+        """
+        Expand a path by getting the absolute path and expanding the user
+        prefix and environment variables.
+
+        # Arguments
+
+        * p (str): The path.
+
+        # Returns
+
+        (str): An expanded path.
+
+        # Raises
+
+        (DotsError): When the name of an undefined environment variable is
+            encountered.
+        """
+        ep = self._memo.get(p)
+        if ep is None:
+            ep = self.expand_all([p])[p]
+        return ep
+
+    def expand_all(self, paths):
+        """
+        Expand many paths at once, and report every undefined environment
+        variable in all of them rather than only the first one.
+
+        # Arguments
+
+        * paths (iterable<str>): The paths.
+
+        # Returns
+
+        (dict<str, str>): The expanded paths by path.
+
+        # Raises
+
+        (DotsError): When names of undefined environment variables are
+            encountered.
+        """
+        expanded = {}
+        # The paths that use each undefined variable
+        errors = {}
+        for p in paths:
+            if p in expanded:
+                continue
+            ep = self._memo.get(p)
+            if ep is None:
+                undefined = []
+                ep = self._expand(p, undefined)
+                if undefined:
+                    for v in dict.fromkeys(undefined):
+                        errors.setdefault(v, []).append(p)
+                    continue
+                self._memo[p] = ep
+            expanded[p] = ep
+        messages = []
+        for v, ps in errors.items():
+            if len(ps) == 1:
+                messages.append(f"${v} in path {ps[0]}")
+            else:
+                messages.append(f"${v} in {len(ps)} paths such as {ps[0]}")
+        if len(messages) == 1:
+            raise DotsError(f"environment variable {messages[0]} not defined")
+        if messages:
+            raise DotsError("environment variables not defined: "
+                + ", ".join(messages))
+        return expanded
+
+# The environment is read once, when the program starts
+PATHS = PathExpander()
+
 def expand_path(p):
     """
     Expand a path by getting the absolute path and expanding the user prefix
-    and environment variables.
+    and environment variables, using the environment of the program when it
+    started. The expanded paths are memoized.
 
     # Arguments
 
@@ -231,19 +446,304 @@ def expand_path(p):
     (DotsError): When the name of an undefined environment variable is
         encountered.
     """
-    ep = os.path.abspath(os.path.expandvars(os.path.expanduser(p)))
-    matches = re.search(r"(\$([a-z_][a-z0-9_]*|{[a-z_][a-z0-9_]*}))",
-        ep, re.IGNORECASE)
-    if matches:
-        v = matches.group(1)
-        raise DotsError(f"environment variable {v} in path {p} not defined")
-    return ep
+    return PATHS.expand(p)
+
+def expand_paths(paths):
+    """
+    Expand many paths at once like `expand_path`.
+
+    # Arguments
+
+    * paths (iterable<str>): The paths.
+
+    # Returns
+
+    (dict<str, str>): The expanded paths by path.
+
+    # Raises
+
+    (DotsError): When names of undefined environment variables are
+        encountered, which are all reported.
+    """
+    return PATHS.expand_all(paths)
+
+class Profiler:
+    """
+    Records the wall and CPU time spent in each phase of a run, along with the
+    number of bytes read and written. When disabled, recording a phase costs
+    almost nothing.
+    """
+
+    class Phase:
+        """
+        A context manager which records a single phase.
+        """
+
+        def __init__(self, profiler, name, args):
+            self.profiler = profiler
+            self.name = name
+            self.args = args
+
+        def __enter__(self):
+            import time
+            self.wall = time.perf_counter()
+            self.cpu = time.thread_time()
+            return self
+
+        def __exit__(self, *_):
+            import time
+            cpu = time.thread_time() - self.cpu
+            wall = time.perf_counter() - self.wall
+            self.profiler._record(self.name, self.args, self.wall, wall, cpu)
+
+    class NullPhase:
+        """
+        A context manager which records nothing.
+        """
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *_):
+            pass
+
+    NULL_PHASE = NullPhase()
+
+    def __init__(self):
+        """
+        Create a new disabled profiler.
+        """
+        self.enabled = False
+        self.events = []
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._lock = None
+        self._origin = 0.0
+
+    def enable(self):
+        """
+        Start recording.
+        """
+        import threading
+        import time
+        self._lock = threading.Lock()
+        self.enabled = True
+        self._origin = time.perf_counter()
+
+    def phase(self, name, **args):
+        """
+        Record a phase.
+
+        # Arguments
+
+        * name (str): The name of the phase.
+        * args (dict): Extra information about the phase, such as the file.
+
+        # Returns
+
+        A context manager which records the phase when it exits.
+        """
+        if not self.enabled:
+            return Profiler.NULL_PHASE
+        return Profiler.Phase(self, name, args)
+
+    def count(self, read=0, written=0):
+        """
+        Count bytes read and written.
+
+        # Arguments
+
+        * read (int): The number of bytes read.
+        * written (int): The number of bytes written.
+        """
+        if self.enabled:
+            with self._lock:
+                self.bytes_read += read
+                self.bytes_written += written
+
+    def _record(self, name, args, start, wall, cpu):
+        import threading
+        event = (name, args, start - self._origin, wall, cpu, threading.get_ident())
+        with self._lock:
+            self.events.append(event)
+
+    def summary(self):
+        """
+        Summarize the recorded phases.
+
+        # Returns
+
+        (dict): The number of times each phase ran with its total wall and CPU
+        time in seconds, and the total bytes read and written.
+        """
+        phases = {}
+        for name, _, _, wall, cpu, _ in self.events:
+            phase = phases.setdefault(name, { "count": 0, "wall": 0.0, "cpu": 0.0 })
+            phase["count"] += 1
+            phase["wall"] += wall
+            phase["cpu"] += cpu
+        return {
+            "phases": phases,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+        }
+
+    def trace_events(self):
+        """
+        Convert the recorded phases into the Chrome trace event format, which
+        can be viewed in `chrome://tracing` or Perfetto.
+
+        # Returns
+
+        (dict): The JSON object representation of the trace.
+        """
+        pid = os.getpid()
+        events = []
+        for name, args, start, wall, cpu, tid in self.events:
+            args = dict((k, str(v)) for k, v in args.items())
+            args["cpu_us"] = round(cpu * 1e6)
+            events.append({
+                "name": name,
+                "ph": "X",
+                "ts": round(start * 1e6),
+                "dur": round(wall * 1e6),
+                "pid": pid,
+                "tid": tid,
+                "args": args,
+            })
+        return {
+            "traceEvents": events,
+            "otherData": {
+                "bytes_read": self.bytes_read,
+                "bytes_written": self.bytes_written,
+            },
+        }
+
+# The profiler shared by the whole process, which is enabled by `--profile`
+PROFILER = Profiler()
+
+def check_bool(value, default, *json_path):
+    """
+    Validate a boolean record field.
+
+    # Arguments
+
+    * value (bool|NoneType): The value.
+    * default (bool): The value to use when `value` is `None`.
+    * json_path (list<str|int>): The path to the error location in the JSON.
+
+    # Returns
+
+    (bool) The field value.
+
+    # Raises
+
+    (JSONError): Where the value is invalid.
+    """
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    raise validation_error("must be a boolean or null", *json_path)
+
+def check_path(value, default, *json_path):
+    """
+    Validate a required path record field. Paths are interned, so the same
+    path appearing in many records is stored once.
+
+    # Arguments
+
+    * value (str): The value.
+    * default (NoneType): Unused, required paths have no default.
+    * json_path (list<str|int>): The path to the error location in the JSON.
+
+    # Returns
+
+    (str) The interned path.
+
+    # Raises
+
+    (JSONError): Where the value is invalid.
+    """
+    if isinstance(value, str) and value:
+        return sys.intern(value)
+    raise validation_error("must be a non-empty string", *json_path)
+
+def check_path_or_none(value, default, *json_path):
+    """
+    Validate an optional path record field. Paths are interned.
+
+    # Arguments
+
+    * value (str|NoneType): The value.
+    * default (str|NoneType): The value to use when `value` is `None`.
+    * json_path (list<str|int>): The path to the error location in the JSON.
+
+    # Returns
+
+    (str|NoneType) The interned path.
+
+    # Raises
+
+    (JSONError): Where the value is invalid.
+    """
+    if value is None:
+        return default
+    if isinstance(value, str) and value:
+        return sys.intern(value)
+    raise validation_error("must be a non-empty string or null", *json_path)
+
+def check_link(value, default, *json_path):
+    """
+    Validate a `Link` record field.
+
+    # Arguments
+
+    * value (str|NoneType): The value.
+    * default (str|NoneType): The value to use when `value` is `None`.
+    * json_path (list<str|int>): The path to the error location in the JSON.
+
+    # Returns
+
+    (str|NoneType) The `Link` constant.
+
+    # Raises
+
+    (JSONError): Where the value is invalid.
+    """
+    if value is None:
+        return default
+    for link in Link.ALL:
+        if value == link:
+            return link
+    quoted = ", ".join(f"\"{c}\"" for c in Link.ALL)
+    raise validation_error(f"must be one of {quoted} or null", *json_path)
+
+def record_fields(*fields):
+    """
+    Create the validation table of a configuration record.
+
+    # Arguments
+
+    * fields (list<tuple<str, function, object>>): The name, the check function
+      and the default value of every field, in slot order. The check functions
+      take the value, the default and the JSON path.
+
+    # Returns
+
+    (dict<str, tuple<int, function, object>>) The index, the check function and
+    the default value by field name.
+    """
+    return { name: (i, check, default)
+        for i, (name, check, default) in enumerate(fields) }
 
 class AbstractConfig(ABC):
     """
     A base class for configurations.
     """
 
+    __slots__ = ()
+
     @abstractmethod
     def to_json(self, minify=True):
         """
@@ -284,9 +784,10 @@ class AbstractConfig(ABC):
         else:
             raise validation_error("must be a boolean or null", *json_path)
 
-    def _parse_str(self, value, name, *json_path):
+    def _parse_str_or_none(self, value, name, *json_path):
         """
-        Parse a non-empty string into an attribute.
+        Parse a non-empty string or `None` into an attribute. When the value is
+        `None`, the attribute is not modified.
 
         # Arguments
 
@@ -298,34 +799,68 @@ class AbstractConfig(ABC):
 
         (JSONError): Where the value is invalid.
         """
-        if not isinstance(value, str) or not value:
-            raise validation_error("must be a non-empty string", *json_path)
-        setattr(self, name, value)
+        default = getattr(self, name)
+        if value is None:
+            setattr(self, name, default)
+        elif isinstance(value, str) or not value:
+            setattr(self, name, value)
+        else:
+            raise validation_error("must be a non-empty string or null", *json_path)
 
-    def _parse_str_or_none(self, value, name, *json_path):
+    def _parse_choice_or_none(self, value, name, choices, *json_path):
         """
-        Parse a non-empty string or `None` into an attribute. When the value is
-        `None`, the attribute is not modified.
+        Parse one of a set of strings or `None` into an attribute. When the
+        value is `None`, the attribute is not modified.
 
         # Arguments
 
         * value (str|NoneType): The value.
         * name (str): The name of the attribute to store the value in.
+        * choices (list<str>): The valid values.
         * json_path (list<str|int>): The path to the error location in the JSON.
 
         # Raises
 
         (JSONError): Where the value is invalid.
         """
-        default = getattr(self, name)
         if value is None:
-            setattr(self, name, default)
-        elif isinstance(value, str) or not value:
+            pass
+        elif value in choices:
             setattr(self, name, value)
         else:
-            raise validation_error("must be a non-empty string or null", *json_path)
+            quoted = ", ".join(f"\"{c}\"" for c in choices)
+            raise validation_error(f"must be one of {quoted} or null", *json_path)
+
+    def _parse_record(self, data, fields, *json_path):
+        """
+        Validate a record mapping against a table from `record_fields` in a
+        single pass.
+
+        # Arguments
+
+        * data (dict): The mapping.
+        * fields (dict<str, tuple<int, function, object>>): The table.
+        * json_path (list<str|int>): The path to the error location in the JSON.
+
+        # Returns
+
+        (list) The field values in slot order, with defaults where unset.
+
+        # Raises
+
+        (JSONError): Where a key or value is invalid.
+        """
+        values = [default for _, _, default in fields.values()]
+        for k, v in data.items():
+            try:
+                i, check, default = fields[k]
+            except KeyError:
+                raise validation_error("is not a valid key", *json_path, k) from None
+            values[i] = check(v, default, *json_path, k)
+        return values
 
     def __str__(self):
+        import json
         return json.dumps(self.to_json())
 
 class Config(AbstractConfig):
@@ -425,6 +960,17 @@ class FileConfig(AbstractConfig):
     Deserialized file configuration.
     """
 
+    # A configuration holds one of these for every file, so they are kept
+    # compact
+    __slots__ = ("dest", "executable", "link", "template", "link_mode")
+
+    FIELDS = record_fields(
+        ("dest", check_path_or_none, None),
+        ("executable", check_bool, Default.FILE_EXECUTABLE),
+        ("link", check_link, Default.FILE_LINK),
+        ("template", check_bool, Default.FILE_TEMPLATE),
+    )
+
     def __init__(self, data, *json_path):
         """
         Create a new file configuration.
@@ -436,34 +982,31 @@ class FileConfig(AbstractConfig):
         * json_path (list<str|int>): The path of the curent location in the
           JSON.
         """
-        self.dest = None
-        self.executable = Default.FILE_EXECUTABLE
-        self.template = Default.FILE_TEMPLATE
         # Parse values
         if isinstance(data, str) and data:
-            self.dest = data
+            self.dest = sys.intern(data)
+            self.executable = Default.FILE_EXECUTABLE
+            self.link = Default.FILE_LINK
+            self.template = Default.FILE_TEMPLATE
         elif isinstance(data, dict):
-            for k, v in data.items():
-                if k == "dest":
-                    self._parse_str_or_none(v, "dest", *json_path)
-                elif k == "executable":
-                    self._parse_bool_or_none(v, "executable", *json_path)
-                elif k == "template":
-                    self._parse_bool_or_none(v, "template", *json_path)
-                else:
-                    raise validation_error("is not a valid key", *json_path, k)
+            self.dest, self.executable, self.link, self.template = \
+                self._parse_record(data, FileConfig.FIELDS, *json_path)
         else:
             raise validation_error("must be a non-empty string or mapping", *json_path)
+        # The link setting after inheriting the package setting
+        self.link_mode = Default.PACKAGE_LINK
 
     def to_json(self, minify=True):
         data = {
             "dest": safe_to_json(self.dest, minify=minify),
             "executable": safe_to_json(self.executable, minify=minify),
+            "link": safe_to_json(self.link, minify=minify),
             "template": safe_to_json(self.template, minify=minify),
         }
         if minify:
             dict_remove_if(data, "dest", None)
             dict_remove_if(data, "executable", None, Default.FILE_EXECUTABLE)
+            dict_remove_if(data, "link", None, Default.FILE_LINK)
             dict_remove_if(data, "template", None, Default.FILE_TEMPLATE)
             # When only dest is specified do not use the whole structure
             if set(data.keys()) == set(["dest"]):
@@ -475,6 +1018,13 @@ class IncludeConfig(AbstractConfig):
     Deserialized variable inclusion configuration.
     """
 
+    __slots__ = ("path", "optional")
+
+    FIELDS = record_fields(
+        ("path", check_path, None),
+        ("optional", check_bool, Default.INCLUDE_OPTIONAL),
+    )
+
     def __init__(self, data, *json_path):
         """
         Create a new variable inclusion configuration.
@@ -486,19 +1036,13 @@ class IncludeConfig(AbstractConfig):
         * json_path (list<str|int>): The path of the curent location in the
           JSON.
         """
-        self.path = None
-        self.optional = Default.INCLUDE_OPTIONAL
         # Parse values
         if isinstance(data, str):
-            self.path = data
+            self.path = sys.intern(data)
+            self.optional = Default.INCLUDE_OPTIONAL
         elif isinstance(data, dict):
-            for k, v in data.items():
-                if k == "path":
-                    self._parse_str(v, "path", *json_path)
-                elif k == "optional":
-                    self._parse_bool_or_none(v, "optional", *json_path)
-                else:
-                    raise validation_error("is not a valid key", *json_path, k)
+            self.path, self.optional = \
+                self._parse_record(data, IncludeConfig.FIELDS, *json_path)
         else:
             raise validation_error("must be a non-empty string or mapping", *json_path)
         # Check values
@@ -534,6 +1078,7 @@ class PackageConfig(AbstractConfig):
           JSON.
         """
         self.files = {}
+        self.link = Default.PACKAGE_LINK
         self.requires = []
         # Parse values
         if data is None:
@@ -542,19 +1087,24 @@ class PackageConfig(AbstractConfig):
             for k, v in data.items():
                 if k == "files":
                     self._parse_files(k, v, *json_path, k)
+                elif k == "link":
+                    self._parse_choice_or_none(v, "link", Link.ALL, *json_path, k)
                 elif k == "requires":
                     self._parse_requires(k, v, *json_path, k)
                 else:
                     raise validation_error("is not a valid key", *json_path, k)
         else:
             raise validation_error("must be a mapping or null", *json_path)
+        # Files inherit the link setting of the package
+        for file_config in self.files.values():
+            file_config.link_mode = file_config.link or self.link
 
     def _parse_files(self, k, v, *json_path):
         if v is None:
             pass
         elif isinstance(v, dict):
             for vk, vv in v.items():
-                self.files[vk] = FileConfig(vv, *json_path, vk)
+                self.files[sys.intern(vk)] = FileConfig(vv, *json_path, vk)
         else:
             raise validation_error("must be a mapping or null", *json_path)
 
@@ -572,10 +1122,12 @@ class PackageConfig(AbstractConfig):
     def to_json(self, minify=True):
         data = {
             "files": safe_to_json(self.files, minify=minify),
+            "link": safe_to_json(self.link, minify=minify),
             "requires": safe_to_json(self.requires, minify=minify),
         }
         if minify:
             dict_remove_if(data, "files", None, {})
+            dict_remove_if(data, "link", None, Default.PACKAGE_LINK)
             dict_remove_if(data, "requires", None, [])
         return data
 
@@ -597,6 +1149,7 @@ class TemplatesConfig(AbstractConfig):
         """
         self.begin = Default.TEMPLATE_BEGIN
         self.end = Default.TEMPLATE_END
+        self.evaluator = Default.TEMPLATE_EVALUATOR
         self.include = []
         self.snippets = Default.TEMPLATE_SNIPPETS
         self.variables = {}
@@ -611,6 +1164,9 @@ class TemplatesConfig(AbstractConfig):
                     self._parse_str_or_none(v, "begin", *json_path)
                 elif k == "end":
                     self._parse_str_or_none(v, "end", *json_path)
+                elif k == "evaluator":
+                    self._parse_choice_or_none(v, "evaluator", Evaluator.ALL,
+                        *json_path, k)
                 elif k == "include":
                     self._parse_include(k, v, *json_path, k)
                 elif k == "snippets":
@@ -645,6 +1201,22 @@ class TemplatesConfig(AbstractConfig):
             raise validation_error("must be a mapping or null", *json_path)
 
     def resolve(self):
+        """
+        Resolve the includes and snippets. Includes are read into `variables`
+        immediately, while snippets are read lazily through `namespace`.
+        """
+        with PROFILER.phase("includes"):
+            self._resolve_includes()
+        with PROFILER.phase("snippets"):
+            self._resolve_snippets()
+        # The compiler and the namespace are shared by every template filled in
+        # with this configuration
+        self.compiler = TemplateCompiler(self.begin, self.end, self.evaluator)
+        self.namespace = Namespace(self.variables, self.snippet_paths)
+        self._digests = {}
+
+    def _resolve_includes(self):
+        import json
         # Coalesce includes into variables
         for include in self.include:
             try:
@@ -667,27 +1239,57 @@ class TemplatesConfig(AbstractConfig):
             else:
                 raise DotsError(f"include file {include.path} must be a mapping of string to string")
             self.variables.update(data)
+
+    def _resolve_snippets(self):
+        # Snippets are only listed here, and each one is read the first time a
+        # template uses it
+        self.snippet_paths = {}
         if self.snippets is not None:
-            for (dirpath, _, filenames) in os.walk(self.snippets):
-                for filename in filenames:
-                    p = os.path.join(dirpath, filename)
-                    try:
-                        data = None
-                        with open(p) as f:
-                            data = f.read()
-                    except FileNotFoundError as ex:
-                        if not include.optional:
-                            raise DotsError(f"snippets file {p} does not exist") from ex
-                    except IOError as ex:
-                        raise DotsError(f"could not open snippets file {p}") from ex
-                    v = os.path.basename(p).split(".")[0] # Remove all extensions
-                    self.variables[v] = data
-                break
+            try:
+                with os.scandir(self.snippets) as entries:
+                    for entry in entries:
+                        if not entry.is_dir():
+                            v = entry.name.split(".")[0] # Remove all extensions
+                            self.snippet_paths[v] = entry.path
+            except FileNotFoundError:
+                pass
+            except OSError as ex:
+                raise DotsError(f"could not open snippets directory {self.snippets}") from ex
+
+    def variable_digest(self, name):
+        """
+        Get the hash of the value of a variable. The hashes are memoized.
+
+        # Arguments
+
+        * name (str): The name of the variable, without the `_` prefix.
+
+        # Returns
+
+        (str): The hexadecimal hash of the value.
+
+        # Raises
+
+        (BuildError): The variable is a snippet which could not be read.
+        """
+        digest = self._digests.get(name)
+        if digest is None:
+            digest = text_digest(self.namespace["_" + name])
+            self._digests[name] = digest
+        return digest
+
+    def __getstate__(self):
+        # The hashes of snippets are found again, since their contents are not
+        # part of the key of the configuration cache
+        state = dict(self.__dict__)
+        state["_digests"] = {}
+        return state
 
     def to_json(self, minify=True):
         data = {
             "begin": safe_to_json(self.begin, minify=minify),
             "end": safe_to_json(self.end, minify=minify),
+            "evaluator": safe_to_json(self.evaluator, minify=minify),
             "include": safe_to_json(self.include, minify=minify),
             "snippets": safe_to_json(self.snippets, minify=minify),
             "variables": safe_to_json(self._original_variables, minify=minify)
@@ -695,22 +1297,134 @@ class TemplatesConfig(AbstractConfig):
         if minify:
             dict_remove_if(data, "begin", None, Default.TEMPLATE_BEGIN)
             dict_remove_if(data, "end", None, Default.TEMPLATE_END)
+            dict_remove_if(data, "evaluator", None, Default.TEMPLATE_EVALUATOR)
             dict_remove_if(data, "include", None, [])
             dict_remove_if(data, "snippets", None, Default.TEMPLATE_SNIPPETS)
             dict_remove_if(data, "variables", None, {})
         return data
 
-def parse_args():
+class Namespace:
     """
-    Create an argument parse for the command line and parse the inputs.
-
-    # Returns
-
-    (Namespace) The parsed arguments.
+    The namespace that template expressions are evaluated in, which is a
+    read-only mapping view of the variables where every variable is available
+    with an `_` prepended to its name. Names are looked up when they are used,
+    so the variables are never copied. Snippets are read the first time they
+    are used, and their contents are memoized.
+
+    This is not a `collections.abc.Mapping`, since importing it slows down
+    starting the program.
     """
-    import argparse
 
-    p = argparse.ArgumentParser(
+    def __init__(self, variables, snippet_paths):
+        """
+        Create a new namespace.
+
+        # Arguments
+
+        * variables (dict<str, str>): The variables.
+        * snippet_paths (dict<str, str>): The paths to the snippet files by
+          variable name. Snippets take precedence over variables.
+        """
+        self.variables = variables
+        self.snippet_paths = snippet_paths
+        self._snippets = {}
+
+    def __getitem__(self, key):
+        if key[:1] != "_":
+            raise KeyError(key)
+        name = key[1:]
+        path = self.snippet_paths.get(name)
+        if path is None:
+            try:
+                return self.variables[name]
+            except KeyError:
+                raise KeyError(key) from None
+        value = self._snippets.get(name)
+        if value is None:
+            value = self._read_snippet(path)
+            self._snippets[name] = value
+        return value
+
+    @staticmethod
+    def _read_snippet(path):
+        try:
+            with PROFILER.phase("snippet", file=path):
+                with open(path) as f:
+                    value = f.read()
+                    PROFILER.count(read=os.fstat(f.fileno()).st_size)
+        except FileNotFoundError as ex:
+            raise BuildError(f"snippets file {path} does not exist") from ex
+        except IOError as ex:
+            raise BuildError(f"could not open snippets file {path}") from ex
+        return value
+
+    def __contains__(self, key):
+        return key[:1] == "_" and (key[1:] in self.snippet_paths
+            or key[1:] in self.variables)
+
+    def __iter__(self):
+        for name in self.variables:
+            if name not in self.snippet_paths:
+                yield "_" + name
+        for name in self.snippet_paths:
+            yield "_" + name
+
+    def __len__(self):
+        return len(self.variables.keys() | self.snippet_paths.keys())
+
+    def get(self, key, default=None):
+        """
+        Get the value of a name, or a default when it does not exist.
+        """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        """
+        Get the names in the namespace.
+        """
+        return list(self)
+
+    def __getstate__(self):
+        # Snippets are read again, since their contents are not part of the
+        # key of the configuration cache
+        state = dict(self.__dict__)
+        state["_snippets"] = {}
+        return state
+
+def parse_args():
+    """
+    Create an argument parse for the command line and parse the inputs.
+
+    # Returns
+
+    (Namespace) The parsed arguments.
+    """
+    import argparse
+
+    def positive_int(s):
+        try:
+            n = int(s)
+        except ValueError:
+            n = 0
+        if n < 1:
+            raise argparse.ArgumentTypeError(f"{s} is not a positive integer")
+        return n
+
+    def size(s):
+        units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+        scale = units.get(s[-1:].upper(), 1)
+        try:
+            n = int(s[:-1] if s[-1:].upper() in units else s) * scale
+        except ValueError:
+            n = -1
+        if n < 0:
+            raise argparse.ArgumentTypeError(f"{s} is not a valid size")
+        return n
+
+    p = argparse.ArgumentParser(
         description="Manage dot files",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     p.set_defaults(subcommand=None)
@@ -724,6 +1438,19 @@ def parse_args():
         help="enable verbose output")
     p.add_argument("-n", "--dry-run", action="store_true",
         help="enable a dry run which does modify any files on disk")
+    p.add_argument("--diff", action="store_true",
+        help="print a diff of the files that would change in a dry run")
+    p.add_argument("-j", "--jobs", metavar="N", type=positive_int, default=1,
+        help="number of files to process concurrently")
+    p.add_argument("--engine", choices=Engine.ALL, default=Engine.THREADS,
+        help="how files are processed concurrently, where asyncio schedules "
+            "the same thread pool from an event loop")
+    p.add_argument("--startup-time", action="store_true",
+        help="report the time it takes to import the program and exit")
+    p.add_argument("--profile", metavar="FILE", default=None,
+        help="record the time spent in each phase and write it to FILE, as a "
+            "cProfile file if FILE ends with .prof and as a Chrome trace "
+            "otherwise")
 
     # Subcommands
     sp = p.add_subparsers(title="subcommands", dest="subcommand",
@@ -732,6 +1459,10 @@ def parse_args():
     sp_build = sp.add_parser("build", help="Build packages locally")
     sp_build.add_argument("packages", metavar="PACKAGE", nargs="*",
         help="package name to operate on")
+    sp_build.add_argument("-f", "--force", action="store_true",
+        help="rebuild files even if they are up to date")
+    sp_build.add_argument("--changed-vars", action="store_true",
+        help="only rebuild templates using variables that changed")
     # Format subcommand
     sp_format = sp.add_parser("format", help="Format the configuration file")
     # Install subcommand
@@ -739,6 +1470,45 @@ def parse_args():
         help="Install packages on the system")
     sp_install.add_argument("packages", metavar="PACKAGE", nargs="*",
         help="package name to operate on")
+    sp_install.add_argument("-f", "--force", action="store_true",
+        help="reinstall files even if they are up to date")
+    sp_install.add_argument("--changed-vars", action="store_true",
+        help="only reinstall templates using variables that changed")
+    # Bench subcommand
+    sp_bench = sp.add_parser("bench",
+        help="Benchmark the build pipeline on a synthetic configuration")
+    sp_bench.add_argument("--packages", metavar="N", type=positive_int,
+        default=50, help="number of packages")
+    sp_bench.add_argument("--files", metavar="M", type=positive_int,
+        default=10, help="number of files per package")
+    sp_bench.add_argument("--variables", metavar="K", type=positive_int,
+        default=100, help="number of template variables")
+    sp_bench.add_argument("--lines", metavar="L", type=positive_int,
+        default=50, help="number of lines per file")
+    sp_bench.add_argument("--density", metavar="D", type=float,
+        default=0.5, help="fraction of lines containing an expression")
+    sp_bench.add_argument("--repeat", metavar="R", type=positive_int,
+        default=3, help="number of times each phase is run")
+    # Watch subcommand
+    sp_watch = sp.add_parser("watch",
+        help="Rebuild packages whenever their sources change")
+    sp_watch.add_argument("packages", metavar="PACKAGE", nargs="*",
+        help="package name to operate on")
+    sp_watch.add_argument("-i", "--install", action="store_true",
+        help="install the packages instead of building them")
+    sp_watch.add_argument("--interval", metavar="SECONDS", type=float,
+        default=Default.WATCH_INTERVAL,
+        help="polling interval when inotify is not available")
+    # GC subcommand
+    sp_gc = sp.add_parser("gc",
+        help="Remove unused rendered templates from the build store")
+    sp_gc.add_argument("--max-size", metavar="SIZE", type=size,
+        default=Default.STORE_MAX_SIZE,
+        help="maximum size of the store in bytes, with an optional K, M or G "
+            "suffix")
+    sp_gc.add_argument("--max-age", metavar="DAYS", type=float,
+        default=Default.STORE_MAX_AGE,
+        help="remove objects which were not used for this many days")
 
     return p.parse_args()
 
@@ -757,16 +1527,11 @@ def format_json(data, filename):
 
     (bool) True if the file war modified, false otherwise.
     """
+    import json
     s = json.dumps(data, indent=2, sort_keys=True)
     with open(filename, "a+") as f:
         f.seek(0)
         original = f.read()
-        f.seek(0)
-        file_contents_valid = True
-        try:
-            original_data = json.load(f)
-        except (OverflowError, TypeError, ValueError):
-            file_contents_valid = False
         clean = s + "\n"
         if original != clean:
             f.truncate(0)
@@ -791,6 +1556,8 @@ def file_modifiers(file_config):
     ms = []
     if file_config.executable:
         ms.append("executable")
+    if file_config.link_mode != Link.COPY:
+        ms.append(file_config.link_mode)
     if file_config.template:
         ms.append("template")
     s = ", ".join(ms)
@@ -798,201 +1565,3408 @@ def file_modifiers(file_config):
         s = f" ({s})"
     return s
 
-def fill_template(templates_config, text):
+def expression_names(source):
     """
-    Fill in a template.
+    Find the names of the variables read by an expression.
 
     # Arguments
 
-    * templates_config (TemplatesConfig): A template configuration.
-    * text (str): The text of the template.
+    * source (str): The source text of the expression.
 
     # Returns
 
-    (str): The filled in template.
+    (set<str>): The names read by the expression, excluding names bound
+    inside of it such as comprehension and lambda variables.
+    """
+    import ast
+    loaded = set()
+    bound = set()
+    for node in ast.walk(ast.parse(source.lstrip(" \t"), mode="eval")):
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                loaded.add(node.id)
+            else:
+                bound.add(node.id)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+    return loaded - bound
+
+def memoize(function):
+    """
+    Memoize a function of hashable arguments. The results are kept for the
+    life of the process, so they are shared by every template.
+
+    # Arguments
+
+    * function (function): The function.
+
+    # Returns
+
+    (function): The memoized function.
+    """
+    cache = {}
+    # Separates the positional arguments from the keyword arguments in keys
+    mark = object()
+
+    def memoized(*args, **kwargs):
+        key = args
+        if kwargs:
+            key = args + (mark,) + tuple(sorted(kwargs.items()))
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        value = function(*args, **kwargs)
+        cache[key] = value
+        return value
+
+    memoized.__name__ = function.__name__
+    memoized.__qualname__ = function.__qualname__
+    memoized.__doc__ = function.__doc__
+    return memoized
+
+@memoize
+def color_parse(color):
+    """
+    Parse a hexadecimal color in the form `rrggbb`, `rgb` or `rrggbbaa`, with an
+    optional `#` or `0x` prefix.
+
+    # Arguments
+
+    * color (str): The color.
+
+    # Returns
+
+    (tuple<float>): The red, green, blue and alpha channels between 0 and 1.
 
     # Raises
 
-    (BuildError): The template was invalid.
+    (ValueError): The color is not valid.
     """
-    local_vs = {}
-    for k, v in templates_config.variables.items():
-        local_vs["_" + k] = v
-    p = re.escape(templates_config.begin) + "(.*?)" + re.escape(templates_config.end)
+    digits = color.strip()
+    for prefix in ("#", "0x"):
+        if digits.startswith(prefix):
+            digits = digits[len(prefix):]
+            break
+    if len(digits) == 3:
+        digits = "".join(c + c for c in digits)
+    if len(digits) == 6:
+        digits += "ff"
     try:
-        text = re.sub(p,
-            lambda m: str(eval(m.groups()[0], {}, local_vs)),
-            text,
-            flags=re.DOTALL)
-    except Exception as ex:
-        raise BuildError(str(ex)) from ex
-    return text
+        if len(digits) != 8:
+            raise ValueError
+        return tuple(int(digits[i:i + 2], 16) / 255 for i in range(0, 8, 2))
+    except ValueError:
+        raise ValueError(f"\"{color}\" is not a valid color") from None
+
+@memoize
+def color_format(color, style="hex"):
+    """
+    Format a color.
 
-def file_executable(file_path, executable):
+    # Arguments
+
+    * color (str): The color.
+    * style (str): One of `hex` (`rrggbb`), `#hex` (`#rrggbb`), `0x`
+      (`0xrrggbb`), `argb` (`#aarrggbb`), `rgb` (`rgb(r, g, b)`) or `rgba`
+      (`rgba(r, g, b, a)`). The hexadecimal styles without an alpha channel
+      have `aa` appended when the color is not opaque.
+
+    # Returns
+
+    (str): The formatted color.
+
+    # Raises
+
+    (ValueError): The color or the style is not valid.
     """
-    Enable or disable executable permissions on a file.
+    r, g, b, a = (round(c * 255) for c in color_parse(color))
+    digits = f"{r:02x}{g:02x}{b:02x}"
+    alpha = f"{a:02x}" if a != 255 else ""
+    if style == "hex":
+        return digits + alpha
+    if style == "#hex":
+        return "#" + digits + alpha
+    if style == "0x":
+        return "0x" + digits + alpha
+    if style == "argb":
+        return f"#{a:02x}{digits}"
+    if style == "rgb":
+        return f"rgb({r}, {g}, {b})"
+    if style == "rgba":
+        return f"rgba({r}, {g}, {b}, {round(a / 255, 3):g})"
+    raise ValueError(f"\"{style}\" is not a valid color style")
+
+def _color_hex(r, g, b, a):
+    # Colors are formatted like the variables, without a prefix
+    channels = [round(min(max(c, 0.0), 1.0) * 255) for c in (r, g, b, a)]
+    if channels[3] == 255:
+        channels.pop()
+    return "".join(f"{c:02x}" for c in channels)
+
+@memoize
+def color_mix(color_a, color_b, weight=0.5):
+    """
+    Mix two colors.
 
     # Arguments
 
-    * file_path (str): The path to the file.
-    * executable (bool): Whether the file should be executable or not.
+    * color_a (str): The first color.
+    * color_b (str): The second color.
+    * weight (float|str): The amount of the second color between 0 and 1.
+
+    # Returns
+
+    (str): The mixed color as `rrggbb`, or `rrggbbaa` when it is not opaque.
     """
-    mask = stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
-    p = os.stat(file_path)[stat.ST_MODE]
-    if executable:
-        pn = p | mask
-    else:
-        pn = p & ~mask
-    # Only change the permission if it is different
-    if pn != p:
-        os.chmod(file_path, pn)
+    t = float(weight)
+    return _color_hex(*(x + (y - x) * t
+        for x, y in zip(color_parse(color_a), color_parse(color_b))))
 
-def process_file(config, file_config, src_path, dest_path=None):
+@memoize
+def color_lighten(color, amount):
     """
-    Process a single file by filling the template, making it executable, and
-    putting it where it belongs on the system.
+    Lighten a color by increasing its lightness in the HLS color space.
 
     # Arguments
 
-    * config (Config): A configuration.
-    * file_config (FileConfig): A file configuration.
-    * src_path (str): The path to the file source.
-    * dest_path (str): The path to the file destination.
+    * color (str): The color.
+    * amount (float|str): The amount to add to the lightness between -1 and
+      1. Negative amounts darken the color.
+
+    # Returns
+
+    (str): The lightened color as `rrggbb`, or `rrggbbaa` when it is not
+    opaque.
     """
-    if dest_path is None:
-        dest_path = file_config.dest
-    if dest_path is not None:
-        dest_path = expand_path(dest_path)
-    # Load file
-    with open(src_path) as f:
-        text = f.read()
-    if file_config.template:
-        text = fill_template(config.templates, text)
-    if dest_path is not None:
-        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-        with open(dest_path, "w") as f:
-            f.write(text)
-        file_executable(dest_path, file_config.executable)
+    import colorsys
+    r, g, b, a = color_parse(color)
+    h, l, s = colorsys.rgb_to_hls(r, g, b)
+    l = min(max(l + float(amount), 0.0), 1.0)
+    return _color_hex(*colorsys.hls_to_rgb(h, l, s), a)
+
+@memoize
+def color_darken(color, amount):
+    """
+    Darken a color by decreasing its lightness in the HLS color space.
 
-def traverse_packages(config, package_names, build=False, install=False,
-        verbose=None, dry_run=None):
+    # Arguments
+
+    * color (str): The color.
+    * amount (float|str): The amount to subtract from the lightness between
+      -1 and 1.
+
+    # Returns
+
+    (str): The darkened color as `rrggbb`, or `rrggbbaa` when it is not
+    opaque.
     """
-    Traverse the packages and run build and install operations.
+    return color_lighten(color, -float(amount))
+
+@memoize
+def color_alpha(color, alpha):
+    """
+    Set the alpha channel of a color.
 
     # Arguments
 
-    * config (Config): The configuraiton.
-    * packages_names (list<str>): A list of package names to install.
-    * build (bool): Build the packages.
-    * install (bool): Install the packages.
-    * verbose (bool): Enable verbose output.
-    * dry_run (bool): Enable dry run output.
+    * color (str): The color.
+    * alpha (float|str): The alpha channel between 0 and 1.
+
+    # Returns
+
+    (str): The color as `rrggbbaa`, or `rrggbb` when it is opaque.
     """
-    for dep in dependent_packages(config, package_names):
-        package = config.packages[dep]
-        files = package.files if package.files else {}
-        for src_path, file_config in files.items():
-            if build:
-                err = False
-                msg = None
-                try:
-                    dest_path = os.path.join(config.build.dir, os.path.relpath(src_path))
-                    process_file(config, file_config, src_path, dest_path=dest_path)
-                except BuildError as ex:
-                    err = True
-                    msg = str(ex)
-                Fmt.status(Title.BUILD + file_modifiers(file_config),
-                    src=src_path, target=dest_path,
-                    msg=msg, err=err,
-                    verbose=verbose, dry_run=dry_run)
-                if err:
-                    sys.exit(1)
-            if install:
-                err = False
-                msg = None
-                try:
-                    process_file(config, file_config, src_path)
-                except BuildError as ex:
-                    err = True
-                    msg = str(ex)
-                Fmt.status(Title.INSTALL + file_modifiers(file_config),
-                    src=src_path, target=file_config.dest,
-                    msg=msg, err=err,
-                    verbose=verbose, dry_run=dry_run)
-                if err:
-                    sys.exit(1)
+    r, g, b, _ = color_parse(color)
+    return _color_hex(r, g, b, float(alpha))
 
-def dependent_packages(config, package_names):
+@memoize
+def px(points, dpi=96):
     """
-    Find all packages that must be installed.
+    Convert a size in points to pixels.
 
     # Arguments
 
-    * config (Config): The configuration.
-    * package_names (list<str>): The packages to be installed.
+    * points (float|str): The size in points.
+    * dpi (float|str): The resolution in dots per inch.
 
     # Returns
 
-    (list<str>) All of the packages in `package_names` plus any dependencies
-    found.
-    """
-    packages = set()
-    candidates = {}
-    for pn in package_names:
-        candidates[pn] = None
-    while candidates:
-        name, required_by = candidates.popitem()
-        if name in config.packages:
-            packages.add(name)
-            for require in config.packages[name].requires:
-                candidates[require] = name
-            for p in packages:
-                if p in candidates:
-                    candidates.pop(p)
+    (int): The size in pixels, rounded to the nearest pixel.
+    """
+    return round(float(points) * float(dpi) / 72)
+
+@memoize
+def pt(pixels, dpi=96):
+    """
+    Convert a size in pixels to points.
+
+    # Arguments
+
+    * pixels (float|str): The size in pixels.
+    * dpi (float|str): The resolution in dots per inch.
+
+    # Returns
+
+    (float): The size in points, rounded to two decimal places.
+    """
+    return round(float(pixels) * 72 / float(dpi), 2)
+
+# The functions that template expressions can call
+TEMPLATE_HELPERS = {
+    "abs": abs,
+    "bin": bin,
+    "bool": bool,
+    "color_alpha": color_alpha,
+    "color_darken": color_darken,
+    "color_format": color_format,
+    "color_lighten": color_lighten,
+    "color_mix": color_mix,
+    "color_parse": color_parse,
+    "float": float,
+    "hex": hex,
+    "int": int,
+    "len": len,
+    "max": max,
+    "min": min,
+    "oct": oct,
+    "px": px,
+    "pt": pt,
+    "round": round,
+    "str": str,
+}
+
+# The string methods that restricted template expressions can call. Methods
+# which format their arguments, such as `format`, are not allowed since format
+# strings can read attributes.
+TEMPLATE_STR_METHODS = frozenset([
+    "capitalize", "center", "count", "endswith", "find", "isdigit", "join",
+    "ljust", "lower", "lstrip", "replace", "rjust", "rstrip", "split",
+    "splitlines", "startswith", "strip", "title", "upper", "zfill",
+])
+
+def restricted_expression(source):
+    """
+    Compile a template expression into a function which evaluates it without
+    `eval`. The expression is parsed once, and each node becomes a closure.
+    Only variables, constants, arithmetic, comparisons, conditionals,
+    subscripts and slices, calls of `TEMPLATE_HELPERS`, and calls of
+    `TEMPLATE_STR_METHODS` on strings are allowed.
+
+    # Arguments
+
+    * source (str): The source text of the expression.
+
+    # Returns
+
+    (function): The compiled expression, which is called with the namespace to
+    evaluate it.
+
+    # Raises
+
+    (SyntaxError): The expression is not valid Python.
+    (ValueError): The expression uses something that is not allowed.
+    """
+    import ast
+    tree = ast.parse(source.lstrip(" \t"), mode="eval")
+    return _restricted_node(tree.body)
+
+def _restricted_node(node):
+    import ast
+    compile_node = _restricted_node
+    if isinstance(node, ast.Constant):
+        value = node.value
+        if not isinstance(value, (str, int, float, bool, type(None))):
+            raise ValueError(f"constant {value!r} is not allowed in template expressions")
+        return lambda namespace: value
+    if isinstance(node, ast.Name):
+        name = node.id
+        if name in TEMPLATE_HELPERS:
+            helper = TEMPLATE_HELPERS[name]
+            return lambda namespace: helper
+        if not name.startswith("_") or name.startswith("__"):
+            raise ValueError(f"name \"{name}\" is not allowed in template expressions")
+
+        def load(namespace):
+            try:
+                return namespace[name]
+            except KeyError:
+                raise NameError(f"name '{name}' is not defined") from None
+
+        return load
+    if isinstance(node, ast.BinOp):
+        left = compile_node(node.left)
+        right = compile_node(node.right)
+        op = type(node.op)
+        if op is ast.Add:
+            return lambda namespace: left(namespace) + right(namespace)
+        if op is ast.Sub:
+            return lambda namespace: left(namespace) - right(namespace)
+        if op is ast.Mult:
+            return lambda namespace: left(namespace) * right(namespace)
+        if op is ast.Div:
+            return lambda namespace: left(namespace) / right(namespace)
+        if op is ast.FloorDiv:
+            return lambda namespace: left(namespace) // right(namespace)
+        if op is ast.Mod:
+            return lambda namespace: left(namespace) % right(namespace)
+    elif isinstance(node, ast.UnaryOp):
+        operand = compile_node(node.operand)
+        op = type(node.op)
+        if op is ast.USub:
+            return lambda namespace: -operand(namespace)
+        if op is ast.UAdd:
+            return lambda namespace: +operand(namespace)
+        if op is ast.Not:
+            return lambda namespace: not operand(namespace)
+    elif isinstance(node, ast.BoolOp):
+        values = [compile_node(value) for value in node.values]
+        if isinstance(node.op, ast.And):
+            def evaluate_and(namespace):
+                for value in values:
+                    result = value(namespace)
+                    if not result:
+                        break
+                return result
+            return evaluate_and
+
+        def evaluate_or(namespace):
+            for value in values:
+                result = value(namespace)
+                if result:
+                    break
+            return result
+
+        return evaluate_or
+    elif isinstance(node, ast.Compare):
+        comparisons = {
+            ast.Eq: lambda a, b: a == b,
+            ast.NotEq: lambda a, b: a != b,
+            ast.Lt: lambda a, b: a < b,
+            ast.LtE: lambda a, b: a <= b,
+            ast.Gt: lambda a, b: a > b,
+            ast.GtE: lambda a, b: a >= b,
+            ast.In: lambda a, b: a in b,
+            ast.NotIn: lambda a, b: a not in b,
+        }
+        left = compile_node(node.left)
+        ops = []
+        for op, comparator in zip(node.ops, node.comparators):
+            if type(op) not in comparisons:
+                break
+            ops.append((comparisons[type(op)], compile_node(comparator)))
         else:
-            if required_by is not None:
-                raise DotsError(
-                    f"package \"{name}\" required by \"{required_by}\" does not exist")
-            raise DotsError(f"package \"{name}\" does not exist")
-    return sorted(packages)
+            def compare(namespace):
+                a = left(namespace)
+                for op, comparator in ops:
+                    b = comparator(namespace)
+                    if not op(a, b):
+                        return False
+                    a = b
+                return True
+
+            return compare
+    elif isinstance(node, ast.IfExp):
+        test = compile_node(node.test)
+        body = compile_node(node.body)
+        orelse = compile_node(node.orelse)
+        return lambda namespace: (body(namespace) if test(namespace)
+            else orelse(namespace))
+    elif isinstance(node, ast.Subscript):
+        value = compile_node(node.value)
+        if isinstance(node.slice, ast.Slice):
+            nodes = (node.slice.lower, node.slice.upper, node.slice.step)
+            if all(n is None or isinstance(n, ast.Constant) for n in nodes):
+                # Constant slices are only created once
+                s = slice(*(None if n is None else n.value for n in nodes))
+                return lambda namespace: value(namespace)[s]
+            lower, upper, step = (
+                (lambda namespace: None) if n is None else compile_node(n)
+                for n in nodes)
+            return lambda namespace: value(namespace)[slice(lower(namespace),
+                upper(namespace), step(namespace))]
+        index = compile_node(node.slice)
+        return lambda namespace: value(namespace)[index(namespace)]
+    elif isinstance(node, ast.Call):
+        if (any(isinstance(arg, ast.Starred) for arg in node.args)
+                or any(keyword.arg is None for keyword in node.keywords)):
+            raise ValueError("argument unpacking is not allowed in template expressions")
+        keywords = dict((keyword.arg, compile_node(keyword.value))
+            for keyword in node.keywords)
+        if isinstance(node.func, ast.Name) and node.func.id in TEMPLATE_HELPERS:
+            return _restricted_call(TEMPLATE_HELPERS[node.func.id],
+                [compile_node(arg) for arg in node.args], keywords)
+        if isinstance(node.func, ast.Attribute):
+            if node.func.attr not in TEMPLATE_STR_METHODS:
+                raise ValueError(
+                    f"method \"{node.func.attr}\" is not allowed in template expressions")
+            # Calling the method of `str` raises a TypeError for anything
+            # that is not a string
+            return _restricted_call(getattr(str, node.func.attr),
+                [compile_node(arg) for arg in [node.func.value] + node.args],
+                keywords)
+        if isinstance(node.func, ast.Name):
+            raise ValueError(
+                f"function \"{node.func.id}\" is not allowed in template expressions")
+    raise ValueError(f"{type(node).__name__} is not allowed in template expressions")
+
+def _restricted_call(function, args, keywords):
+    if keywords:
+        return lambda namespace: function(*[arg(namespace) for arg in args],
+            **dict((k, v(namespace)) for k, v in keywords.items()))
+    # Calls with few positional arguments, which are the most common ones, are
+    # specialized to avoid building an argument list
+    if len(args) == 0:
+        return lambda namespace: function()
+    if len(args) == 1:
+        a, = args
+        return lambda namespace: function(a(namespace))
+    if len(args) == 2:
+        a, b = args
+        return lambda namespace: function(a(namespace), b(namespace))
+    return lambda namespace: function(*[arg(namespace) for arg in args])
+
+class Template:
+    """
+    A compiled template, which is a sequence of literal text segments and
+    compiled expressions.
+    """
 
-def main():
-    args = parse_args()
+    def __init__(self, segments, names):
+        """
+        Create a new compiled template.
 
-    with open(args.config_file) as f:
-        data = json.load(f)
-        config = Config(data)
+        # Arguments
 
-    run_format = False
+        * segments (list<str|function>): The literal text segments and
+          compiled expressions in the order that they appear in the template.
+        * names (set<str>): The names read by the expressions.
+        """
+        self.segments = segments
+        self.names = names
 
-    if args.subcommand == "build":
-        traverse_packages(config, args.packages, build=True, install=False,
-                 verbose=args.verbose, dry_run=args.dry_run)
-    elif args.subcommand == "format":
-        run_format = True
-    elif args.subcommand == "install":
-        traverse_packages(config, args.packages, build=False, install=True,
-                 verbose=args.verbose, dry_run=args.dry_run)
-    else:
-        # This will never be hit
-        Fmt.status(Title.EXCEPTION, src=args.subcommand,
-            msg="Command not specified", err=True)
-        sys.exit(1)
+    def render(self, namespace):
+        """
+        Render the template.
 
-    if run_format or config.build.format:
-        written = False
-        if not args.dry_run:
-            written = format_json(config.to_json(), filename=args.config_file)
-        if args.dry_run or written:
-            Fmt.status(Title.FORMAT, src=args.config_file,
-                verbose=args.verbose, dry_run=args.dry_run)
+        # Arguments
 
-if __name__ == "__main__":
-    try:
-        main()
-    except (json.decoder.JSONDecodeError, JSONError) as ex:
-        Fmt.status(Title.EXCEPTION, src="JSON Validation", msg=str(ex), err=True)
-    except FileNotFoundError as ex:
-        Fmt.status(Title.EXCEPTION, msg=str(ex), err=True)
-    except DotsError as ex:
-        Fmt.status(Title.EXCEPTION, msg=str(ex), err=True)
+        * namespace (Mapping): The variables available to the expressions.
+
+        # Returns
+
+        (str): The filled in template.
+        """
+        parts = []
+        for segment in self.segments:
+            if isinstance(segment, str):
+                parts.append(segment)
+            else:
+                parts.append(str(segment(namespace)))
+        return "".join(parts)
+
+class TemplateCompiler:
+    """
+    Compiles template text into `Template` objects. Expressions are cached by
+    their source text and templates are cached by the hash of their contents,
+    so each distinct template and expression is only ever compiled once.
+    """
+
+    def __init__(self, begin, end, evaluator=Default.TEMPLATE_EVALUATOR):
+        """
+        Create a new template compiler.
+
+        # Arguments
+
+        * begin (str): The template interpolation beginning token.
+        * end (str): The template interpolation ending token.
+        * evaluator (str): How expressions are evaluated, from `Evaluator`.
+        """
+        self.begin = begin
+        self.end = end
+        self.evaluator = evaluator
+        self._pattern = None
+        self._expressions = {}
+        self._names = {}
+        self._templates = {}
+
+    @property
+    def pattern(self):
+        """
+        The regular expression matching an expression and its delimiters. It
+        is compiled the first time it is used.
+        """
+        if self._pattern is None:
+            import re
+            self._pattern = re.compile(
+                re.escape(self.begin) + "(.*?)" + re.escape(self.end), re.DOTALL)
+        return self._pattern
+
+    def __getstate__(self):
+        # Compiled expressions can not be pickled, so the caches are not kept
+        state = self.__dict__.copy()
+        state["_pattern"] = None
+        state["_expressions"] = {}
+        state["_names"] = {}
+        state["_templates"] = {}
+        return state
+
+    def expression(self, source):
+        """
+        Compile a single template expression.
+
+        # Arguments
+
+        * source (str): The source text of the expression.
+
+        # Returns
+
+        (function): The compiled expression, which is called with the
+        namespace to evaluate it.
+
+        # Raises
+
+        (SyntaxError): The expression is not valid Python.
+        (ValueError): The expression is not allowed by the restricted
+        evaluator.
+        """
+        function = self._expressions.get(source)
+        if function is None:
+            if self.evaluator == Evaluator.EVAL:
+                # Leading spaces and tabs are stripped to match the behavior of
+                # `eval` on source text
+                code = compile(source.lstrip(" \t"), "<template>", "eval")
+                # The helpers are available as globals, in addition to the
+                # builtins
+                helpers = dict(TEMPLATE_HELPERS)
+                function = lambda namespace: eval(code, helpers, namespace)
+            else:
+                function = restricted_expression(source)
+            self._names[source] = expression_names(source)
+            self._expressions[source] = function
+        return function
+
+    def compile(self, text):
+        """
+        Compile a template.
+
+        # Arguments
+
+        * text (str): The text of the template.
+
+        # Returns
+
+        (Template): The compiled template.
+        """
+        import hashlib
+        key = hashlib.sha256(text.encode("utf-8", "surrogateescape")).digest()
+        template = self._templates.get(key)
+        if template is None:
+            segments = []
+            names = set()
+            i = 0
+            for m in self.pattern.finditer(text):
+                if m.start() > i:
+                    segments.append(text[i:m.start()])
+                segments.append(self.expression(m.group(1)))
+                names.update(self._names[m.group(1)])
+                i = m.end()
+            if i < len(text):
+                segments.append(text[i:])
+            template = Template(segments, names)
+            self._templates[key] = template
+        return template
+
+    def segments(self, f, chunk_size=Default.CHUNK_SIZE):
+        """
+        Split a template into segments while reading it in chunks, so that
+        memory is bounded by the chunk size and the length of the longest
+        expression rather than the size of the template. Delimiters split
+        across chunks are handled.
+
+        # Arguments
+
+        * f (file): The template, opened in text mode.
+        * chunk_size (int): The number of characters to read at a time.
+
+        # Returns
+
+        (generator<(bool, str)>): Pairs of whether the segment is an
+        expression and its text.
+        """
+        buf = ""
+        in_expression = False
+        eof = False
+        while not eof:
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf += chunk
+            while True:
+                if not in_expression:
+                    i = buf.find(self.begin)
+                    if i < 0:
+                        # A partial beginning delimiter may be at the end
+                        keep = 0 if eof else len(self.begin) - 1
+                        if len(buf) > keep:
+                            yield False, buf[:len(buf) - keep]
+                            buf = buf[len(buf) - keep:]
+                        break
+                    if i > 0:
+                        yield False, buf[:i]
+                    buf = buf[i + len(self.begin):]
+                    in_expression = True
+                else:
+                    j = buf.find(self.end)
+                    if j < 0:
+                        break
+                    yield True, buf[:j]
+                    buf = buf[j + len(self.end):]
+                    in_expression = False
+        if in_expression:
+            # An unterminated expression is left as it is
+            yield False, self.begin + buf
+
+    def compile_stream(self, src_path):
+        """
+        Compile a template without loading it into memory. The template is read
+        once to compile its expressions and again each time it is rendered.
+
+        # Arguments
+
+        * src_path (str): The path to the template.
+
+        # Returns
+
+        (StreamTemplate): The compiled template.
+        """
+        import hashlib
+        h = hashlib.sha256()
+        names = set()
+        with open(src_path) as f:
+            for is_expression, text in self.segments(f):
+                if is_expression:
+                    self.expression(text)
+                    names.update(self._names[text])
+                    text = self.begin + text + self.end
+                h.update(text.encode("utf-8", "surrogateescape"))
+        return StreamTemplate(self, src_path, names, h.hexdigest())
+
+class StreamTemplate:
+    """
+    A compiled template which is rendered straight from its source file to a
+    destination file object.
+    """
+
+    def __init__(self, compiler, src_path, names, digest):
+        """
+        Create a new streamed template.
+
+        # Arguments
+
+        * compiler (TemplateCompiler): The compiler of the expressions.
+        * src_path (str): The path to the template.
+        * names (set<str>): The names read by the expressions.
+        * digest (str): The hash of the template text, which is the same as
+          `text_digest` of the whole text.
+        """
+        self.compiler = compiler
+        self.src_path = src_path
+        self.names = names
+        self.digest = digest
+
+    def render_to(self, f, namespace):
+        """
+        Render the template into a file.
+
+        # Arguments
+
+        * f (file): The destination, opened in text mode.
+        * namespace (Mapping): The variables available to the expressions.
+        """
+        with open(self.src_path) as src:
+            for is_expression, text in self.compiler.segments(src):
+                if is_expression:
+                    text = str(self.compiler.expression(text)(namespace))
+                f.write(text)
+
+def compile_template(templates_config, text):
+    """
+    Compile a template.
+
+    # Arguments
+
+    * templates_config (TemplatesConfig): A template configuration.
+    * text (str): The text of the template.
+
+    # Returns
+
+    (Template): The compiled template.
+
+    # Raises
+
+    (BuildError): The template was invalid.
+    """
+    try:
+        return templates_config.compiler.compile(text)
+    except Exception as ex:
+        raise BuildError(str(ex)) from ex
+
+def template_variables(template):
+    """
+    Find the variables used by a template.
+
+    # Arguments
+
+    * template (Template): The compiled template.
+
+    # Returns
+
+    (set<str>): The names of the variables without the `_` prefix. Names that
+    are not defined are included too.
+    """
+    return set(name[1:] for name in template.names if name.startswith("_"))
+
+def render_template(templates_config, template):
+    """
+    Render a compiled template.
+
+    # Arguments
+
+    * templates_config (TemplatesConfig): A template configuration.
+    * template (Template): The compiled template.
+
+    # Returns
+
+    (str): The filled in template.
+
+    # Raises
+
+    (BuildError): An expression in the template could not be evaluated.
+    """
+    try:
+        return template.render(templates_config.namespace)
+    except Exception as ex:
+        raise BuildError(str(ex)) from ex
+
+def render_stream(templates_config, template, dest_path, executable):
+    """
+    Render a streamed template into a file.
+
+    # Arguments
+
+    * templates_config (TemplatesConfig): A template configuration.
+    * template (StreamTemplate): The compiled template.
+    * dest_path (str): The path to the destination, or `None` to only
+      evaluate the template.
+    * executable (bool): Whether the file should be executable or not.
+
+    # Returns
+
+    (str|NoneType): The hash of the rendered file, or `None` when there is no
+    destination.
+
+    # Raises
+
+    (BuildError): An expression in the template could not be evaluated.
+    """
+    def render(f):
+        try:
+            template.render_to(f, templates_config.namespace)
+        except Exception as ex:
+            raise BuildError(str(ex)) from ex
+
+    if dest_path is None:
+        with open(os.devnull, "w") as f:
+            render(f)
+        return None
+    with open(template.src_path) as f:
+        encoding = f.encoding
+    return write_stream(dest_path, executable, encoding, render)
+
+def fill_template(templates_config, text):
+    """
+    Fill in a template.
+
+    # Arguments
+
+    * templates_config (TemplatesConfig): A template configuration.
+    * text (str): The text of the template.
+
+    # Returns
+
+    (str): The filled in template.
+
+    # Raises
+
+    (BuildError): The template was invalid.
+    """
+    template = compile_template(templates_config, text)
+    return render_template(templates_config, template)
+
+def text_digest(text):
+    """
+    Hash a string.
+
+    # Arguments
+
+    * text (str): The string.
+
+    # Returns
+
+    (str): The hexadecimal SHA-256 digest of the string.
+    """
+    import hashlib
+    return hashlib.sha256(text.encode("utf-8", "surrogateescape")).hexdigest()
+
+class Manifest:
+    """
+    A record of the outputs written by previous runs, which is stored in the
+    build directory. Each output records the hashes of everything used to
+    produce it, so outputs whose inputs have not changed can be skipped.
+    """
+
+    def __init__(self, path):
+        """
+        Load a manifest. A missing or invalid manifest file is treated as
+        empty.
+
+        # Arguments
+
+        * path (str): The path to the manifest file.
+        """
+        import json
+        import threading
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._modified = False
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                self.entries = data
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def inputs(templates_config, file_config, source, template=None):
+        """
+        Collect the hashes of the inputs used to produce an output.
+
+        # Arguments
+
+        * templates_config (TemplatesConfig): A template configuration.
+        * file_config (FileConfig): A file configuration.
+        * source (str): The hash of the source file.
+        * template (Template): The compiled template, if the file is one.
+
+        # Returns
+
+        (dict): The inputs.
+        """
+        variables = {}
+        if template is not None:
+            for name in template_variables(template):
+                if "_" + name in templates_config.namespace:
+                    variables[name] = templates_config.variable_digest(name)
+        flags = {
+            "executable": file_config.executable,
+            "template": file_config.template,
+        }
+        if template is not None:
+            # The delimiters change how the source is parsed
+            flags["begin"] = templates_config.begin
+            flags["end"] = templates_config.end
+            flags["evaluator"] = templates_config.evaluator
+        return {
+            "source": source,
+            "variables": variables,
+            "flags": flags,
+        }
+
+    def is_current(self, dest_path, inputs):
+        """
+        Check whether an output is up to date.
+
+        # Arguments
+
+        * dest_path (str): The path to the output.
+        * inputs (dict): The inputs from `Manifest.inputs`.
+
+        # Returns
+
+        (bool): True if the output was produced from the same inputs and has
+        not been modified since.
+        """
+        entry = self.entries.get(dest_path)
+        if not isinstance(entry, dict):
+            return False
+        for k, v in inputs.items():
+            if entry.get(k) != v:
+                return False
+        try:
+            st = os.lstat(dest_path)
+        except OSError:
+            return False
+        return (entry.get("size") == st.st_size
+            and entry.get("mtime") == st.st_mtime_ns
+            and entry.get("mode") == st.st_mode)
+
+    def record(self, dest_path, inputs, output):
+        """
+        Record an output which has just been written.
+
+        # Arguments
+
+        * dest_path (str): The path to the output.
+        * inputs (dict): The inputs from `Manifest.inputs`.
+        * output (str): The hash of the contents of the output.
+        """
+        st = os.lstat(dest_path)
+        entry = dict(inputs)
+        entry["output"] = output
+        entry["size"] = st.st_size
+        entry["mtime"] = st.st_mtime_ns
+        entry["mode"] = st.st_mode
+        with self._lock:
+            self.entries[dest_path] = entry
+            self._modified = True
+
+    def save(self):
+        """
+        Write the manifest to disk if it has been modified.
+        """
+        import json
+        with self._lock:
+            if not self._modified:
+                return
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "w") as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+                f.write("\n")
+            self._modified = False
+
+class DependencyIndex:
+    """
+    A persistent reverse index from each template variable to the outputs that
+    use it, which is stored in the build directory. Each output records the
+    hash of the value it was rendered with, so the outputs affected by changed
+    variables can be found without reading any templates.
+    """
+
+    def __init__(self, path):
+        """
+        Load a dependency index. A missing or invalid index file is treated as
+        empty.
+
+        # Arguments
+
+        * path (str): The path to the index file.
+        """
+        import json
+        import threading
+        self.path = path
+        # Maps each variable to a mapping of output to the hash of the value
+        self.variables = {}
+        # Maps each output to the variables it uses
+        self._outputs = {}
+        self._lock = threading.Lock()
+        self._modified = False
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                self.variables = data
+        except (OSError, ValueError):
+            pass
+        for name, outputs in self.variables.items():
+            for output in outputs:
+                self._outputs.setdefault(output, set()).add(name)
+
+    def record(self, dest_path, variables):
+        """
+        Record the variables used by an output.
+
+        # Arguments
+
+        * dest_path (str): The path to the output.
+        * variables (dict<str, str>): The hashes of the values of the variables
+          used by the output by name.
+        """
+        with self._lock:
+            for name in self._outputs.pop(dest_path, set()):
+                outputs = self.variables.get(name, {})
+                outputs.pop(dest_path, None)
+                if not outputs:
+                    self.variables.pop(name, None)
+            for name, digest in variables.items():
+                self.variables.setdefault(name, {})[dest_path] = digest
+            self._outputs[dest_path] = set(variables)
+            self._modified = True
+
+    def changed_outputs(self, templates_config):
+        """
+        Find the outputs using a variable whose value has changed since the
+        output was recorded.
+
+        # Arguments
+
+        * templates_config (TemplatesConfig): A template configuration.
+
+        # Returns
+
+        (set<str>): The paths to the outputs.
+        """
+        changed = set()
+        for name, outputs in self.variables.items():
+            digest = None
+            if "_" + name in templates_config.namespace:
+                digest = templates_config.variable_digest(name)
+            for output, recorded in outputs.items():
+                if recorded != digest:
+                    changed.add(output)
+        return changed
+
+    def save(self):
+        """
+        Write the index to disk if it has been modified.
+        """
+        import json
+        with self._lock:
+            if not self._modified:
+                return
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "w") as f:
+                json.dump(self.variables, f, indent=2, sort_keys=True)
+                f.write("\n")
+            self._modified = False
+
+class ObjectStore:
+    """
+    A content addressed store of rendered templates in the build directory.
+    Each object is named by the hash of its contents, so identical outputs are
+    only stored once, and an index maps the hash of the inputs of an output
+    from `Manifest.inputs` to the object it produced, so an output rendered by
+    an earlier run, such as before switching branches or themes, is reused
+    without rendering it.
+
+    Objects are read-only copies which are never linked to outputs, since
+    outputs may be installed as links and edited through them. The contents of
+    an object are checked against its hash before it is used.
+    """
+
+    def __init__(self, path):
+        """
+        Load an object store. A missing or invalid index is treated as empty.
+
+        # Arguments
+
+        * path (str): The path to the store directory.
+        """
+        import json
+        import threading
+        self.path = path
+        self.index_path = os.path.join(path, "index.json")
+        # Maps the hash of the inputs to the object and when it was last used
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._modified = False
+        self._directories = set()
+        try:
+            with open(self.index_path) as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                self.entries = data
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def key(inputs):
+        """
+        Hash the inputs of an output.
+
+        # Arguments
+
+        * inputs (dict): The inputs from `Manifest.inputs`.
+
+        # Returns
+
+        (str): The hash.
+        """
+        import json
+        return text_digest(json.dumps(inputs, sort_keys=True))
+
+    def object_path(self, output):
+        """
+        Get the path to an object.
+
+        # Arguments
+
+        * output (str): The hash of the contents.
+
+        # Returns
+
+        (str): The path.
+        """
+        return os.path.join(self.path, "objects", output[:2], output[2:])
+
+    def verify(self, object_path, output):
+        """
+        Check that an object has not been modified, and remove it when it has.
+
+        # Arguments
+
+        * object_path (str): The path to the object.
+        * output (str): The hash the contents should have.
+
+        # Returns
+
+        (bool): True if the object exists and is intact.
+        """
+        try:
+            if file_digest(object_path) == output:
+                return True
+            os.unlink(object_path)
+        except OSError:
+            pass
+        return False
+
+    def lookup(self, key):
+        """
+        Find the object produced by some inputs.
+
+        # Arguments
+
+        * key (str): The hash of the inputs from `ObjectStore.key`.
+
+        # Returns
+
+        (str, str)|NoneType: The path to the object and the hash of its
+        contents, or `None` when it is not stored.
+        """
+        import time
+        entry = self.entries.get(key)
+        if not isinstance(entry, dict):
+            return None
+        output = entry.get("output", "")
+        object_path = self.object_path(output)
+        if not self.verify(object_path, output):
+            with self._lock:
+                self.entries.pop(key, None)
+                self._modified = True
+            return None
+        with self._lock:
+            entry["used"] = time.time()
+            self._modified = True
+        return object_path, entry["output"]
+
+    def insert(self, key, dest_path, output):
+        """
+        Store an output which has just been written by copying it into the
+        store, unless an intact identical object is already stored. Outputs
+        which can not be copied are not stored.
+
+        # Arguments
+
+        * key (str): The hash of the inputs from `ObjectStore.key`.
+        * dest_path (str): The path to the output.
+        * output (str): The hash of the contents of the output.
+        """
+        import shutil
+        import time
+        object_path = self.object_path(output)
+        if not self.verify(object_path, output):
+            try:
+                directory = os.path.dirname(object_path)
+                if directory not in self._directories:
+                    os.makedirs(directory, exist_ok=True)
+                    self._directories.add(directory)
+                mode = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+                replace_file(object_path, mode,
+                    lambda tmp_path: shutil.copyfile(dest_path, tmp_path))
+            except OSError:
+                return
+            # The output may have changed while it was copied
+            if not self.verify(object_path, output):
+                return
+        with self._lock:
+            self.entries[key] = {
+                "output": output,
+                "used": time.time(),
+            }
+            self._modified = True
+
+    def objects(self):
+        """
+        List the objects in the store.
+
+        # Returns
+
+        (dict<str, os.stat_result>): The status of each object by path.
+        """
+        objects = {}
+        try:
+            with os.scandir(os.path.join(self.path, "objects")) as dirs:
+                for d in dirs:
+                    if not d.is_dir(follow_symlinks=False):
+                        continue
+                    with os.scandir(d.path) as entries:
+                        for entry in entries:
+                            if entry.is_file(follow_symlinks=False):
+                                objects[entry.path] = entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            pass
+        return objects
+
+    def collect(self, max_size=Default.STORE_MAX_SIZE,
+            max_age=Default.STORE_MAX_AGE, dry_run=False):
+        """
+        Remove objects from the store. Objects which are not in the index or
+        were not used for `max_age` days are removed, and then the least
+        recently used ones are removed until the store is no larger than
+        `max_size`.
+
+        # Arguments
+
+        * max_size (int): The maximum size of the store in bytes.
+        * max_age (float): The maximum age of an unused object in days.
+        * dry_run (bool): Find the objects to remove without removing them.
+
+        # Returns
+
+        (list<(str, int)>): The paths and sizes of the removed objects.
+        """
+        import time
+        objects = self.objects()
+        # The last time each object was used by any of its entries
+        used = {}
+        for key, entry in list(self.entries.items()):
+            object_path = None
+            if isinstance(entry, dict):
+                object_path = self.object_path(entry.get("output", ""))
+            if object_path not in objects:
+                del self.entries[key]
+                self._modified = True
+                continue
+            used[object_path] = max(used.get(object_path, 0), entry.get("used", 0))
+        # Sort the objects from the least recently used
+        candidates = sorted((used.get(p, 0), p) for p in objects)
+        total = sum(st.st_size for st in objects.values())
+        oldest = time.time() - max_age * 24 * 60 * 60
+        removed = []
+        for t, object_path in candidates:
+            if object_path in used and t >= oldest and total <= max_size:
+                continue
+            size = objects[object_path].st_size
+            if not dry_run:
+                try:
+                    os.unlink(object_path)
+                except OSError:
+                    continue
+            total -= size
+            removed.append((object_path, size))
+        if removed and not dry_run:
+            paths = set(p for p, _ in removed)
+            for key, entry in list(self.entries.items()):
+                object_path = self.object_path(entry["output"])
+                if object_path in paths:
+                    del self.entries[key]
+            self._modified = True
+        return removed
+
+    def save(self):
+        """
+        Write the index to disk if it has been modified.
+        """
+        import json
+        with self._lock:
+            if not self._modified:
+                return
+            os.makedirs(self.path, exist_ok=True)
+            with open(self.index_path, "w") as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+                f.write("\n")
+            self._modified = False
+
+class BuildContext:
+    """
+    State shared by all of the files processed in a single run.
+    """
+
+    def __init__(self, manifest=None, index=None, force=False, store=None):
+        """
+        Create a new build context.
+
+        # Arguments
+
+        * manifest (Manifest): The manifest used to skip unchanged outputs.
+        * index (DependencyIndex): The index which records the variables used
+          by each output.
+        * force (bool): Process every file even if its output is up to date.
+        * store (ObjectStore): The store used to reuse rendered templates.
+        """
+        self.manifest = manifest
+        self.index = index
+        self.force = force
+        self.store = store
+        # The directories which are known to exist, so each one is only
+        # created once per run
+        self.directories = set()
+        # The names of the variables used by each template by source path
+        self.dependencies = {}
+
+def make_directory(path, context=None):
+    """
+    Create a directory and its parents, unless it was already created in this
+    run.
+
+    # Arguments
+
+    * path (str): The path to the directory.
+    * context (BuildContext): The state shared by the run, which records the
+      directories that exist.
+    """
+    if context is not None and path in context.directories:
+        return
+    os.makedirs(path, exist_ok=True)
+    if context is not None:
+        # The parents exist too
+        while path and path not in context.directories:
+            context.directories.add(path)
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+
+def file_executable(file_path, executable):
+    """
+    Enable or disable executable permissions on a file.
+
+    # Arguments
+
+    * file_path (str): The path to the file.
+    * executable (bool): Whether the file should be executable or not.
+    """
+    mask = stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+    p = os.stat(file_path)[stat.ST_MODE]
+    if executable:
+        pn = p | mask
+    else:
+        pn = p & ~mask
+    # Only change the permission if it is different
+    if pn != p:
+        os.chmod(file_path, pn)
+
+def current_umask():
+    """
+    Get the file mode creation mask of the process.
+
+    # Returns
+
+    (int): The umask.
+    """
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+# The umask is read once, since reading it requires temporarily changing it
+UMASK = current_umask()
+
+def destination_mode(dest_path, executable):
+    """
+    Find the status of a destination file and the mode it should have.
+
+    # Arguments
+
+    * dest_path (str): The path to the file.
+    * executable (bool): Whether the file should be executable or not.
+
+    # Returns
+
+    (os.stat_result|NoneType, int, int): The status of the file, which is
+    `None` when it does not exist, is a symbolic link or is hard linked
+    elsewhere, followed by its current mode and the mode it should have. Such
+    files are replaced rather than modified, so writing a copy never writes
+    through a link into another file, such as a source installed as a hard
+    link.
+    """
+    mask = stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+    try:
+        st = os.lstat(dest_path)
+        if stat.S_ISLNK(st.st_mode):
+            st = None
+    except FileNotFoundError:
+        st = None
+    if st is not None:
+        mode = stat.S_IMODE(st.st_mode)
+        if st.st_nlink > 1:
+            st = None
+    else:
+        mode = 0o666 & ~UMASK
+    if executable:
+        mode_new = mode | mask
+    else:
+        mode_new = mode & ~mask
+    return st, mode, mode_new
+
+def replace_file(dest_path, mode, fill):
+    """
+    Atomically replace a file with a new one, so a reader never sees a
+    partially written file.
+
+    # Arguments
+
+    * dest_path (str): The path to the file.
+    * mode (int): The mode of the new file, which is set before it replaces
+      the old one.
+    * fill (function): Called with the path to a temporary file in the same
+      directory to write the contents of the new file.
+    """
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path),
+        prefix="." + os.path.basename(dest_path) + ".")
+    try:
+        os.close(fd)
+        fill(tmp_path)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def write_file(dest_path, data, executable):
+    """
+    Write data to a file if its contents differ and set whether it is
+    executable. The file is replaced atomically.
+
+    # Arguments
+
+    * dest_path (str): The path to the file. A symbolic link at this path is
+      replaced, so a file installed as a link can be installed as a copy.
+    * data (bytes): The contents of the file.
+    * executable (bool): Whether the file should be executable or not.
+
+    # Returns
+
+    (bool): True if the contents of the file were written.
+    """
+    st, mode, mode_new = destination_mode(dest_path, executable)
+    # Compare the sizes before the contents to avoid reading the file
+    if st is not None and stat.S_ISREG(st.st_mode) and st.st_size == len(data):
+        with open(dest_path, "rb") as f:
+            unchanged = f.read() == data
+        PROFILER.count(read=len(data))
+        if unchanged:
+            if mode_new != mode:
+                with PROFILER.phase("chmod", file=dest_path):
+                    os.chmod(dest_path, mode_new)
+            return False
+
+    def fill(tmp_path):
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+
+    replace_file(dest_path, mode_new, fill)
+    PROFILER.count(written=len(data))
+    return True
+
+def write_stream(dest_path, executable, encoding, render):
+    """
+    Render a file into a temporary file, then replace the destination with it
+    if the contents differ and set whether it is executable. The contents are
+    compared by size and a streaming hash, so the file is never loaded into
+    memory.
+
+    # Arguments
+
+    * dest_path (str): The path to the file. A symbolic link at this path is
+      replaced.
+    * executable (bool): Whether the file should be executable or not.
+    * encoding (str): The text encoding of the file.
+    * render (function): Called with the temporary file, opened in text mode,
+      to write the contents.
+
+    # Returns
+
+    (str): The hash of the contents from `file_digest`.
+    """
+    import tempfile
+    st, mode, mode_new = destination_mode(dest_path, executable)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path),
+        prefix="." + os.path.basename(dest_path) + ".")
+    try:
+        with os.fdopen(fd, "w", encoding=encoding, newline="\n") as f:
+            render(f)
+        size = os.stat(tmp_path).st_size
+        PROFILER.count(written=size)
+        digest = file_digest(tmp_path)
+        if (st is not None and stat.S_ISREG(st.st_mode) and st.st_size == size
+                and file_digest(dest_path) == digest):
+            os.unlink(tmp_path)
+            if mode_new != mode:
+                with PROFILER.phase("chmod", file=dest_path):
+                    os.chmod(dest_path, mode_new)
+            return digest
+        os.chmod(tmp_path, mode_new)
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return digest
+
+def file_digest(file_path):
+    """
+    Hash the contents of a file without loading it all into memory.
+
+    # Arguments
+
+    * file_path (str): The path to the file.
+
+    # Returns
+
+    (str): The hexadecimal SHA-256 digest of the contents.
+    """
+    import hashlib
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(Default.CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+            PROFILER.count(read=len(chunk))
+    return h.hexdigest()
+
+def copy_file(src_path, dest_path, executable, src_digest=None):
+    """
+    Copy a file as bytes if the contents differ and set whether it is
+    executable. The copy is done by the kernel where it is supported, and the
+    contents are compared by size and a streaming hash, so large files are
+    never loaded into memory. The file is replaced atomically.
+
+    # Arguments
+
+    * src_path (str): The path to the source file.
+    * dest_path (str): The path to the destination file. A symbolic link at
+      this path is replaced.
+    * executable (bool): Whether the file should be executable or not.
+    * src_digest (str): The hash of the source from `file_digest`, when it is
+      already known.
+
+    # Returns
+
+    (bool): True if the contents of the file were written.
+    """
+    import shutil
+    st, mode, mode_new = destination_mode(dest_path, executable)
+    size = os.stat(src_path).st_size
+    if st is not None and stat.S_ISREG(st.st_mode) and st.st_size == size:
+        if src_digest is None:
+            src_digest = file_digest(src_path)
+        if file_digest(dest_path) == src_digest:
+            if mode_new != mode:
+                with PROFILER.phase("chmod", file=dest_path):
+                    os.chmod(dest_path, mode_new)
+            return False
+    replace_file(dest_path, mode_new,
+        lambda tmp_path: shutil.copyfile(src_path, tmp_path))
+    PROFILER.count(read=size, written=size)
+    return True
+
+def link_file(dest_path, target_path, hardlink=False):
+    """
+    Create a symbolic or hard link to a file, unless the link already exists.
+    The link is replaced atomically.
+
+    # Arguments
+
+    * dest_path (str): The path to the link.
+    * target_path (str): The absolute path to the file to link to.
+    * hardlink (bool): Create a hard link instead of a symbolic link.
+
+    # Returns
+
+    (bool): True if the link was created.
+
+    # Raises
+
+    (BuildError): The link could not be created.
+    """
+    if plan_link(dest_path, target_path, hardlink) == Plan.UNCHANGED:
+        return False
+    tmp_path = os.path.join(os.path.dirname(dest_path),
+        f".{os.path.basename(dest_path)}.{os.urandom(4).hex()}")
+    try:
+        if hardlink:
+            os.link(target_path, tmp_path)
+        else:
+            os.symlink(target_path, tmp_path)
+        os.replace(tmp_path, dest_path)
+    except OSError as ex:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise BuildError(f"could not link {dest_path} to {target_path}: {ex.strerror}") from ex
+    return True
+
+def plan_link(dest_path, target_path, hardlink=False):
+    """
+    Find what creating a symbolic or hard link to a file would change.
+
+    # Arguments
+
+    * dest_path (str): The path to the link.
+    * target_path (str): The absolute path to the file to link to.
+    * hardlink (bool): Check for a hard link instead of a symbolic link.
+
+    # Returns
+
+    (str): The change from `Plan`, which is never `Plan.CHMOD`.
+    """
+    try:
+        st = os.lstat(dest_path)
+    except FileNotFoundError:
+        return Plan.CREATE
+    if hardlink:
+        try:
+            target = os.stat(target_path)
+        except FileNotFoundError:
+            return Plan.UPDATE
+        if (not stat.S_ISLNK(st.st_mode)
+                and (st.st_dev, st.st_ino) == (target.st_dev, target.st_ino)):
+            return Plan.UNCHANGED
+    elif stat.S_ISLNK(st.st_mode) and os.readlink(dest_path) == target_path:
+        return Plan.UNCHANGED
+    return Plan.UPDATE
+
+def files_equal(path_a, path_b):
+    """
+    Compare the contents of two files of the same size in chunks, so they are
+    never loaded into memory.
+
+    # Arguments
+
+    * path_a (str): The path to the first file.
+    * path_b (str): The path to the second file.
+
+    # Returns
+
+    (bool): True if the contents are identical.
+    """
+    with open(path_a, "rb") as fa, open(path_b, "rb") as fb:
+        while True:
+            a = fa.read(Default.CHUNK_SIZE)
+            b = fb.read(Default.CHUNK_SIZE)
+            PROFILER.count(read=len(a) + len(b))
+            if a != b:
+                return False
+            if not a:
+                return True
+
+class CompareWriter:
+    """
+    A text file which compares what is written to it with the contents of an
+    existing file as it is written, so neither is kept in memory.
+    """
+
+    def __init__(self, f, encoding):
+        """
+        Create a new comparing writer.
+
+        # Arguments
+
+        * f (file|NoneType): The existing file, opened in binary mode, or
+          `None` when there is no file to compare with.
+        * encoding (str): The text encoding of the file.
+        """
+        self.f = f
+        self.encoding = encoding
+        self.equal = f is not None
+
+    def write(self, s):
+        """
+        Compare a string with the next part of the existing file.
+        """
+        if self.equal:
+            data = s.encode(self.encoding)
+            self.equal = self.f.read(len(data)) == data
+            PROFILER.count(read=len(data))
+        return len(s)
+
+    def finish(self):
+        """
+        Finish comparing.
+
+        # Returns
+
+        (bool): True if everything written is identical to the existing file.
+        """
+        return self.equal and self.f.read(1) == b""
+
+def file_diff(dest_path, src_path, text=None):
+    """
+    Create a unified diff of a destination file and its new contents.
+
+    # Arguments
+
+    * dest_path (str): The path to the destination, which may not exist.
+    * src_path (str): The path to the source of the new contents.
+    * text (str|NoneType): The new contents, or `None` when they are the
+      contents of `src_path`.
+
+    # Returns
+
+    (str): The diff, or a note when either file is too large or is binary.
+    """
+    import difflib
+    paths = [dest_path] if text is not None else [dest_path, src_path]
+    for path in paths:
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            continue
+        if size > Default.DIFF_SIZE:
+            return f"Files {dest_path} and {src_path} differ\n"
+    from_path = dest_path
+    try:
+        with open(dest_path) as f:
+            old = f.read()
+    except (FileNotFoundError, IsADirectoryError):
+        old = ""
+        from_path = os.devnull
+    except UnicodeDecodeError:
+        old = None
+    if text is None and old is not None:
+        try:
+            with open(src_path) as f:
+                text = f.read()
+        except UnicodeDecodeError:
+            pass
+    if old is None or text is None:
+        return f"Binary files {dest_path} and {src_path} differ\n"
+    lines = difflib.unified_diff(old.splitlines(keepends=True),
+        text.splitlines(keepends=True), fromfile=from_path, tofile=src_path)
+    return "".join(line if line.endswith("\n") else line + "\n"
+        for line in lines)
+
+def plan_file(config, file_config, src_path, dest_path=None, diff=False,
+        context=None):
+    """
+    Find what processing a single file would change without writing anything.
+    Templates are rendered in memory, or compared with the destination while
+    they are rendered when they are streamed, and other files are compared in
+    chunks.
+
+    # Arguments
+
+    * config (Config): A configuration.
+    * file_config (FileConfig): A file configuration.
+    * src_path (str): The path to the file source.
+    * dest_path (str): The path to the file destination, or `None` to plan
+      installing the file.
+    * diff (bool): Create a diff of the files that would be created or
+      updated.
+    * context (BuildContext): The state shared by the run, where the
+      variables used by templates are recorded.
+
+    # Returns
+
+    (str, str|NoneType): The change from `Plan`, followed by the diff.
+
+    # Raises
+
+    (BuildError): The template was invalid or could not be evaluated.
+    """
+    install = dest_path is None
+    if dest_path is None:
+        dest_path = file_config.dest
+    if dest_path is not None:
+        dest_path = expand_path(dest_path)
+    executable = file_config.executable
+    if install and dest_path is not None and file_config.link_mode != Link.COPY:
+        # The link is unchanged when it already exists, but the file it links
+        # to can still change
+        if file_config.template:
+            target_path = os.path.join(config.build.dir, os.path.relpath(src_path))
+            action, text = plan_file(config, file_config, src_path,
+                dest_path=target_path, diff=diff, context=context)
+        else:
+            target_path = src_path
+            _, mode, mode_new = destination_mode(target_path, executable)
+            action = Plan.CHMOD if mode_new != mode else Plan.UNCHANGED
+            text = None
+        link = plan_link(dest_path, os.path.abspath(target_path),
+            hardlink=file_config.link_mode == Link.HARDLINK)
+        return (action if link == Plan.UNCHANGED else link), text
+    template = None
+    stream = (file_config.template
+        and os.stat(src_path).st_size > Default.TEMPLATE_STREAM_SIZE)
+    if stream:
+        with PROFILER.phase("compile", file=src_path):
+            try:
+                template = config.templates.compiler.compile_stream(src_path)
+            except Exception as ex:
+                raise BuildError(str(ex)) from ex
+    elif file_config.template:
+        with PROFILER.phase("read", file=src_path):
+            with open(src_path) as f:
+                text = f.read()
+                encoding = f.encoding
+        with PROFILER.phase("compile", file=src_path):
+            template = compile_template(config.templates, text)
+    if template is not None and context is not None:
+        context.dependencies[src_path] = template_variables(template)
+    st = None
+    if dest_path is not None:
+        st, mode, mode_new = destination_mode(dest_path, executable)
+    regular = st is not None and stat.S_ISREG(st.st_mode)
+    text = None
+    if stream:
+        with open(src_path) as f:
+            encoding = f.encoding
+        with PROFILER.phase("render", file=src_path):
+            with open(dest_path if regular else os.devnull, "rb") as f:
+                writer = CompareWriter(f if regular else None, encoding)
+                try:
+                    template.render_to(writer, config.templates.namespace)
+                except Exception as ex:
+                    raise BuildError(str(ex)) from ex
+                same = writer.finish()
+    elif template is not None:
+        with PROFILER.phase("render", file=src_path):
+            text = render_template(config.templates, template)
+        data = text.encode(encoding)
+        same = regular and st.st_size == len(data)
+        if same:
+            with open(dest_path, "rb") as f:
+                same = f.read() == data
+            PROFILER.count(read=len(data))
+    else:
+        same = (regular and st.st_size == os.stat(src_path).st_size
+            and files_equal(src_path, dest_path))
+    if dest_path is None:
+        return Plan.UNCHANGED, None
+    if st is None:
+        action = Plan.UPDATE if os.path.lexists(dest_path) else Plan.CREATE
+    elif not same:
+        action = Plan.UPDATE
+    elif mode_new != mode:
+        action = Plan.CHMOD
+    else:
+        action = Plan.UNCHANGED
+    if not diff or action not in (Plan.CREATE, Plan.UPDATE):
+        return action, None
+    with PROFILER.phase("diff", file=dest_path):
+        if stream:
+            return action, f"Files {dest_path} and {src_path} differ\n"
+        return action, file_diff(dest_path, src_path, text)
+
+def process_file(config, file_config, src_path, dest_path=None, context=None):
+    """
+    Process a single file by filling the template, making it executable, and
+    putting it where it belongs on the system.
+
+    # Arguments
+
+    * config (Config): A configuration.
+    * file_config (FileConfig): A file configuration.
+    * src_path (str): The path to the file source.
+    * dest_path (str): The path to the file destination.
+    * context (BuildContext): The state shared by the run. When it has a
+      manifest, outputs that are up to date are skipped.
+
+    When `dest_path` is not given the file is installed, and it is installed as
+    a link when the file is configured to be. Templates are linked to their
+    output in the build directory and other files are linked to the source.
+    """
+    import hashlib
+    install = dest_path is None
+    if dest_path is None:
+        dest_path = file_config.dest
+    if dest_path is not None:
+        dest_path = expand_path(dest_path)
+    if install and dest_path is not None and file_config.link_mode != Link.COPY:
+        if file_config.template:
+            target_path = os.path.join(config.build.dir, os.path.relpath(src_path))
+            process_file(config, file_config, src_path, dest_path=target_path,
+                context=context)
+        else:
+            target_path = src_path
+            file_executable(target_path, file_config.executable)
+        with PROFILER.phase("link", file=dest_path):
+            make_directory(os.path.dirname(dest_path), context)
+            link_file(dest_path, os.path.abspath(target_path),
+                hardlink=file_config.link_mode == Link.HARDLINK)
+        return
+    # Templates are loaded as text, while other files are copied as bytes and
+    # never loaded
+    template = None
+    source = None
+    stream = (file_config.template
+        and os.stat(src_path).st_size > Default.TEMPLATE_STREAM_SIZE)
+    if stream:
+        # Large templates are rendered while they are read
+        with PROFILER.phase("compile", file=src_path):
+            try:
+                template = config.templates.compiler.compile_stream(src_path)
+            except Exception as ex:
+                raise BuildError(str(ex)) from ex
+        if context is not None:
+            context.dependencies[src_path] = template_variables(template)
+        source = template.digest
+    elif file_config.template:
+        with PROFILER.phase("read", file=src_path):
+            with open(src_path) as f:
+                text = f.read()
+                encoding = f.encoding
+                PROFILER.count(read=os.fstat(f.fileno()).st_size)
+        with PROFILER.phase("compile", file=src_path):
+            template = compile_template(config.templates, text)
+        if context is not None:
+            context.dependencies[src_path] = template_variables(template)
+        source = text_digest(text)
+    manifest = None
+    store = None
+    if context is not None and dest_path is not None:
+        manifest = context.manifest
+        if template is not None:
+            store = context.store
+    if manifest is not None or store is not None:
+        if source is None:
+            with PROFILER.phase("read", file=src_path):
+                source = file_digest(src_path)
+        inputs = Manifest.inputs(config.templates, file_config, source, template)
+        if context.index is not None:
+            context.index.record(dest_path, inputs["variables"])
+        if (manifest is not None and not context.force
+                and manifest.is_current(dest_path, inputs)):
+            return
+    if store is not None:
+        # Rendered templates are reused from the store by copying the object
+        key = ObjectStore.key(inputs)
+        found = None if context.force else store.lookup(key)
+        if found is not None:
+            object_path, output = found
+            try:
+                with PROFILER.phase("store", file=dest_path):
+                    make_directory(os.path.dirname(dest_path), context)
+                    copy_file(object_path, dest_path, file_config.executable,
+                        src_digest=output)
+            except OSError:
+                # The object was removed, so the template is rendered
+                found = None
+            if found is not None:
+                if manifest is not None:
+                    manifest.record(dest_path, inputs, output)
+                return
+    if stream:
+        with PROFILER.phase("render", file=src_path):
+            if dest_path is not None:
+                make_directory(os.path.dirname(dest_path), context)
+            output = render_stream(config.templates, template, dest_path,
+                file_config.executable)
+        if store is not None and not install:
+            store.insert(key, dest_path, output)
+        if manifest is not None:
+            manifest.record(dest_path, inputs, output)
+        return
+    if template is not None:
+        with PROFILER.phase("render", file=src_path):
+            text = render_template(config.templates, template)
+    if dest_path is not None:
+        with PROFILER.phase("write", file=dest_path):
+            make_directory(os.path.dirname(dest_path), context)
+            if template is not None:
+                data = text.encode(encoding)
+                write_file(dest_path, data, file_config.executable)
+                output = hashlib.sha256(data).hexdigest()
+            else:
+                copy_file(src_path, dest_path, file_config.executable,
+                    src_digest=source)
+                output = source
+        if store is not None and not install:
+            store.insert(key, dest_path, output)
+        if manifest is not None:
+            manifest.record(dest_path, inputs, output)
+
+def process_task(config, task, context=None):
+    """
+    Run a single build or install task.
+
+    # Arguments
+
+    * config (Config): The configuration.
+    * task (tuple): A task created by `traverse_packages`.
+    * context (BuildContext): The state shared by the run.
+
+    # Returns
+
+    (str|NoneType): The error message when the task failed, otherwise `None`.
+    """
+    _, file_config, src_path, dest_path, _ = task
+    try:
+        process_file(config, file_config, src_path, dest_path=dest_path,
+            context=context)
+    except BuildError as ex:
+        return str(ex)
+    return None
+
+def plan_task(config, task, diff=False, context=None):
+    """
+    Find what a single build or install task would change.
+
+    # Arguments
+
+    * config (Config): The configuration.
+    * task (tuple): A task created by `package_tasks`.
+    * diff (bool): Create a diff of the files that would change.
+    * context (BuildContext): The state shared by the run.
+
+    # Returns
+
+    (str|NoneType, str|NoneType, str|NoneType): The change from `Plan` and
+    the diff, followed by the error message when the task failed.
+    """
+    _, file_config, src_path, dest_path, _ = task
+    try:
+        action, text = plan_file(config, file_config, src_path,
+            dest_path=dest_path, diff=diff, context=context)
+    except BuildError as ex:
+        return None, None, str(ex)
+    return action, text, None
+
+def plan_tasks(config, tasks, verbose=None, diff=False, jobs=1, context=None):
+    """
+    Find what the tasks would change without writing anything, and print the
+    plan grouped by the kind of change. Diffs are printed in task order while
+    the tasks run, and only a bounded number of tasks are in flight at once,
+    so memory use does not grow with the number of files.
+
+    # Arguments
+
+    * config (Config): The configuration.
+    * tasks (list<tuple>): The tasks created by `package_tasks`. Since nothing
+      is written, the order of the dependency levels does not matter.
+    * verbose (bool): List the unchanged files too.
+    * diff (bool): Print a diff of the files that would change.
+    * jobs (int): The number of files to process concurrently.
+    * context (BuildContext): The state shared by the run.
+
+    # Returns
+
+    (bool): False if a task failed, in which case the rest are not run.
+    """
+    groups = dict((action, []) for action in Plan.ALL)
+
+    def report(task, result):
+        title, file_config, src_path, _, target = task
+        action, text, msg = result
+        if msg is not None:
+            Fmt.status(title + file_modifiers(file_config),
+                src=src_path, target=target, msg=msg, err=True, dry_run=True)
+            return False
+        groups[action].append(task)
+        if text:
+            sys.stdout.write(text)
+        return True
+
+    ok = True
+    if jobs <= 1:
+        for task in tasks:
+            if not report(task, plan_task(config, task, diff, context)):
+                ok = False
+                break
+    else:
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        pending = deque()
+        try:
+            for task in tasks:
+                pending.append((task,
+                    executor.submit(plan_task, config, task, diff, context)))
+                # Wait for the oldest task before submitting more, so only
+                # the results of a few tasks are held at once
+                if len(pending) >= 2 * jobs:
+                    done, future = pending.popleft()
+                    if not report(done, future.result()):
+                        ok = False
+                        break
+            while ok and pending:
+                done, future = pending.popleft()
+                ok = report(done, future.result())
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    for action in Plan.ALL:
+        Fmt.status(Title.PLAN, src=action, msg=f"{len(groups[action])} files",
+            dry_run=True)
+        if action == Plan.UNCHANGED and not verbose:
+            continue
+        for title, file_config, src_path, _, target in groups[action]:
+            Fmt.status(title + file_modifiers(file_config),
+                src=src_path, target=target, dry_run=True)
+    return ok
+
+def select_tasks(levels, outputs=None):
+    """
+    Restrict tasks to the ones which write to some outputs.
+
+    # Arguments
+
+    * levels (list<list<tuple>>): The tasks created by `package_tasks`.
+    * outputs (set<str>|NoneType): The expanded destination paths to restrict
+      the tasks to, or `None` to keep every task.
+
+    # Returns
+
+    (list<list<tuple>>): The selected tasks grouped by dependency level.
+    """
+    if outputs is None:
+        return levels
+
+    def selected(task):
+        dest_path = task[3] if task[3] is not None else task[1].dest
+        return dest_path is not None and expand_path(dest_path) in outputs
+
+    return [[task for task in tasks if selected(task)] for tasks in levels]
+
+def traverse_packages(config, package_names, build=False, install=False,
+        verbose=None, dry_run=None, jobs=1, force=False, changed_vars=False,
+        diff=False, engine=Engine.THREADS):
+    """
+    Traverse the packages and run build and install operations.
+
+    # Arguments
+
+    * config (Config): The configuraiton.
+    * packages_names (list<str>): A list of package names to install.
+    * build (bool): Build the packages.
+    * install (bool): Install the packages.
+    * verbose (bool): Enable verbose output.
+    * dry_run (bool): Enable dry run output.
+    * jobs (int): The number of files to process concurrently. The status
+      output is always printed in the same order regardless of this value.
+    * force (bool): Process every file even if its output is up to date.
+    * changed_vars (bool): Only process the templates that use a variable
+      whose value changed since they were last processed.
+    * diff (bool): Print a diff of the files that would change in a dry run.
+    * engine (str): How files are processed concurrently, from `Engine`.
+
+    In a dry run nothing is written, and the plan of the changes is printed
+    instead.
+    """
+    index = DependencyIndex(os.path.join(config.build.dir, Default.BUILD_INDEX))
+    outputs = None
+    if changed_vars:
+        outputs = index.changed_outputs(config.templates)
+    if dry_run:
+        levels = select_tasks(package_tasks(config, package_names, build=build,
+            install=install), outputs)
+        if not plan_tasks(config, [task for tasks in levels for task in tasks],
+                verbose=verbose, diff=diff, jobs=jobs):
+            sys.exit(1)
+        return
+    manifest = Manifest(os.path.join(config.build.dir, Default.BUILD_MANIFEST))
+    store = ObjectStore(os.path.join(config.build.dir, Default.BUILD_STORE))
+    context = BuildContext(manifest=manifest, index=index, force=force,
+        store=store)
+    try:
+        run_tasks(config, package_names, context, build=build, install=install,
+            verbose=verbose, dry_run=dry_run, jobs=jobs, outputs=outputs,
+            engine=engine)
+    finally:
+        manifest.save()
+        index.save()
+        store.save()
+
+def package_tasks(config, package_names, build=False, install=False):
+    """
+    Create the build and install tasks for the packages.
+
+    # Arguments
+
+    * config (Config): The configuraiton.
+    * packages_names (list<str>): A list of package names.
+    * build (bool): Create tasks to build the packages.
+    * install (bool): Create tasks to install the packages.
+
+    # Returns
+
+    (list<list<tuple>>): The tasks grouped by dependency level. Each task is
+    (title, file config, source, destination, display target).
+    """
+    levels = []
+    for level in dependency_levels(config, package_names):
+        tasks = []
+        for dep in level:
+            package = config.packages[dep]
+            files = package.files if package.files else {}
+            for src_path, file_config in files.items():
+                if build:
+                    dest_path = os.path.join(config.build.dir, os.path.relpath(src_path))
+                    tasks.append((Title.BUILD, file_config, src_path, dest_path, dest_path))
+                if install:
+                    tasks.append((Title.INSTALL, file_config, src_path, None, file_config.dest))
+        levels.append(tasks)
+    # Every destination is expanded up front, so all of the undefined
+    # environment variables are reported together
+    expand_paths(task[1].dest for tasks in levels for task in tasks
+        if task[3] is None and task[1].dest is not None)
+    return levels
+
+def report_task(task, msg, verbose=None, dry_run=None):
+    """
+    Print the status of a task.
+
+    # Arguments
+
+    * task (tuple): A task created by `package_tasks`.
+    * msg (str|NoneType): The error message when the task failed.
+    * verbose (bool): Enable verbose output.
+    * dry_run (bool): Enable dry run output.
+
+    # Returns
+
+    (bool): True if the task failed.
+    """
+    title, file_config, src_path, _, target = task
+    err = msg is not None
+    Fmt.status(title + file_modifiers(file_config),
+        src=src_path, target=target,
+        msg=msg, err=err,
+        verbose=verbose, dry_run=dry_run)
+    return err
+
+def run_tasks(config, package_names, context, build=False, install=False,
+        verbose=None, dry_run=None, jobs=1, outputs=None, engine=Engine.THREADS):
+    """
+    Create the build and install tasks for the packages and run them. The
+    arguments are the same as `traverse_packages`, except for `outputs`, which
+    is the set of expanded destination paths to restrict the tasks to.
+    """
+    levels = select_tasks(package_tasks(config, package_names, build=build,
+        install=install), outputs)
+    report = lambda task, msg: report_task(task, msg, verbose, dry_run)
+    prepare_directories(config, levels, context, jobs=jobs)
+
+    if engine == Engine.ASYNCIO:
+        if not run_tasks_async(config, levels, context, verbose=verbose,
+                dry_run=dry_run, jobs=jobs):
+            sys.exit(1)
+        return
+
+    if jobs <= 1:
+        for tasks in levels:
+            for task in tasks:
+                if report(task, process_task(config, task, context)):
+                    sys.exit(1)
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        # Packages in the same level do not depend on each other, so their
+        # files are processed concurrently. Results are reported in submission
+        # order so the output is deterministic, and the first failure cancels
+        # everything not started.
+        for tasks in levels:
+            futures = [executor.submit(process_task, config, task, context)
+                for task in tasks]
+            for task, future in zip(tasks, futures):
+                if report(task, future.result()):
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    sys.exit(1)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def task_directories(config, task):
+    """
+    Find the directories that a task writes in.
+
+    # Arguments
+
+    * config (Config): The configuration.
+    * task (tuple): A task created by `package_tasks`.
+
+    # Returns
+
+    (list<str>): The directories. Templates installed as links are also
+    written in the build directory.
+    """
+    # The paths are expanded as `process_file` expands them, so they match the
+    # directories it records in the context
+    _, file_config, src_path, dest_path, _ = task
+    if dest_path is not None:
+        return [os.path.dirname(expand_path(dest_path))]
+    if file_config.dest is None:
+        return []
+    directories = [os.path.dirname(expand_path(file_config.dest))]
+    if file_config.link_mode != Link.COPY and file_config.template:
+        directories.append(os.path.dirname(expand_path(
+            os.path.join(config.build.dir, os.path.relpath(src_path)))))
+    return directories
+
+def prepare_directories(config, levels, context, jobs=1):
+    """
+    Create every directory that the tasks write in before any file is
+    written, so each directory is only created once. Only the deepest
+    directories are created, since creating them creates their parents.
+    Directories which can not be created are left for the tasks that write in
+    them to report.
+
+    # Arguments
+
+    * config (Config): The configuration.
+    * levels (list<list<tuple>>): The tasks created by `package_tasks`.
+    * context (BuildContext): The state shared by the run.
+    * jobs (int): The number of directories to create concurrently.
+    """
+    needed = set(d for tasks in levels for task in tasks
+        for d in task_directories(config, task))
+    parents = set()
+    for path in needed:
+        path = os.path.dirname(path)
+        while path and path not in parents:
+            parents.add(path)
+            if os.path.dirname(path) == path:
+                break
+            path = os.path.dirname(path)
+    deepest = sorted(needed - parents - context.directories)
+
+    def create(path):
+        try:
+            make_directory(path, context)
+        except OSError:
+            pass
+
+    with PROFILER.phase("directories"):
+        if jobs <= 1 or len(deepest) <= 1:
+            for path in deepest:
+                create(path)
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                list(executor.map(create, deepest))
+
+def run_tasks_async(config, levels, context, verbose=None, dry_run=None,
+        jobs=1):
+    """
+    Run build and install tasks from an event loop. This is a thin wrapper
+    which runs each whole task on a pool of `jobs` threads, so it has the same
+    ordering, failure handling and concurrency as `run_tasks`: results are
+    reported in task order as soon as they are available, and the first
+    failure cancels everything not started.
+
+    # Arguments
+
+    * config (Config): The configuration.
+    * levels (list<list<tuple>>): The tasks created by `package_tasks`.
+    * context (BuildContext): The state shared by the run.
+    * verbose (bool): Enable verbose output.
+    * dry_run (bool): Enable dry run output.
+    * jobs (int): The number of tasks to run concurrently.
+
+    # Returns
+
+    (bool): False if a task failed.
+    """
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    async def run_levels(executor):
+        loop = asyncio.get_running_loop()
+        for tasks in levels:
+            # The executor bounds the number of tasks which run at once
+            futures = [loop.run_in_executor(executor, process_task, config, task,
+                context) for task in tasks]
+            try:
+                for task, future in zip(tasks, futures):
+                    if report_task(task, await future, verbose, dry_run):
+                        return False
+            finally:
+                # Tasks which already started finish before returning
+                for future in futures:
+                    future.cancel()
+                await asyncio.gather(*futures, return_exceptions=True)
+        return True
+
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        return asyncio.run(run_levels(executor))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def collect_store(config, max_size=Default.STORE_MAX_SIZE,
+        max_age=Default.STORE_MAX_AGE, verbose=None, dry_run=None):
+    """
+    Remove unused rendered templates from the store in the build directory.
+
+    # Arguments
+
+    * config (Config): The configuration.
+    * max_size (int): The maximum size of the store in bytes.
+    * max_age (float): The maximum age of an unused object in days.
+    * verbose (bool): Enable verbose output.
+    * dry_run (bool): Enable dry run output, which does not remove anything.
+    """
+    store = ObjectStore(os.path.join(config.build.dir, Default.BUILD_STORE))
+    removed = store.collect(max_size=max_size, max_age=max_age, dry_run=dry_run)
+    for object_path, size in removed:
+        Fmt.status(Title.GC, src=object_path, msg=f"{size} bytes",
+            verbose=verbose, dry_run=dry_run)
+    Fmt.status(Title.GC, src=store.path,
+        msg=f"removed {len(removed)} objects, {sum(s for _, s in removed)} bytes",
+        verbose=verbose, dry_run=dry_run)
+    if not dry_run:
+        store.save()
+
+def dependency_levels(config, package_names):
+    """
+    Find all packages that must be installed and group them into dependency
+    levels. The packages in a level only depend on packages in earlier levels,
+    so the packages within a level are independent of each other. This runs in
+    linear time in the number of packages and requirements. A package which
+    requires itself is not a cycle, and the requirement is ignored.
+
+    # Arguments
+
+    * config (Config): The configuration.
+    * package_names (list<str>): The packages to be installed.
+
+    # Returns
+
+    (list<list<str>>) All of the packages in `package_names` plus any
+    dependencies found, grouped by level. Each level is sorted by name.
+
+    # Raises
+
+    (DotsError): A package does not exist or the requirements contain a cycle.
+    """
+    with PROFILER.phase("dependencies"):
+        return _dependency_levels(config.packages, package_names)
+
+def _dependency_levels(packages, package_names):
+    # The length of the longest chain of requirements below each package
+    depths = {}
+    for root in package_names:
+        if root in depths:
+            continue
+        if root not in packages:
+            raise DotsError(f"package \"{root}\" does not exist")
+        # Iterative depth first search, where `path` is the chain of packages
+        # currently being visited and `stack` holds their requirement iterators
+        path = [root]
+        on_path = set(path)
+        stack = [iter(packages[root].requires)]
+        while stack:
+            name = path[-1]
+            for require in stack[-1]:
+                # A package requiring itself has always been accepted
+                if require in depths or require == name:
+                    continue
+                if require in on_path:
+                    cycle = path[path.index(require):] + [require]
+                    cycle = " -> ".join(f"\"{p}\"" for p in cycle)
+                    raise DotsError(f"package requirements contain a cycle: {cycle}")
+                if require not in packages:
+                    raise DotsError(
+                        f"package \"{require}\" required by \"{name}\" does not exist")
+                path.append(require)
+                on_path.add(require)
+                stack.append(iter(packages[require].requires))
+                break
+            else:
+                stack.pop()
+                path.pop()
+                on_path.remove(name)
+                depths[name] = 1 + max((depths[r] for r in packages[name].requires
+                    if r != name), default=-1)
+    levels = [[] for _ in range(1 + max(depths.values(), default=-1))]
+    for name, depth in depths.items():
+        levels[depth].append(name)
+    return [sorted(level) for level in levels]
+
+def dependent_packages(config, package_names):
+    """
+    Find all packages that must be installed.
+
+    # Arguments
+
+    * config (Config): The configuration.
+    * package_names (list<str>): The packages to be installed.
+
+    # Returns
+
+    (list<str>) All of the packages in `package_names` plus any dependencies
+    found, in an order where every package comes after its dependencies.
+    """
+    return [name for level in dependency_levels(config, package_names)
+        for name in level]
+
+class PollingWatcher:
+    """
+    Watches paths for changes by periodically comparing their status.
+    """
+
+    def __init__(self, paths, interval=Default.WATCH_INTERVAL):
+        """
+        Create a new polling watcher.
+
+        # Arguments
+
+        * paths (list<str>): The absolute paths of the files and directories
+          to watch. The entries of a directory are watched too.
+        * interval (float): The interval in seconds between checks.
+        """
+        self.paths = set(paths)
+        self.interval = interval
+        self._snapshot = self._scan(self.paths)
+
+    def _scan(self, paths):
+        snapshot = {}
+        for path in paths:
+            snapshot[path] = self._stat(path)
+            if os.path.isdir(path):
+                try:
+                    with os.scandir(path) as entries:
+                        for entry in entries:
+                            snapshot[entry.path] = self._stat(entry.path)
+                except OSError:
+                    pass
+        return snapshot
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime_ns, st.st_mode)
+
+    def wait(self):
+        """
+        Wait for changes.
+
+        # Returns
+
+        (set<str>): The paths that changed.
+        """
+        import time
+        while True:
+            time.sleep(self.interval)
+            snapshot = self._scan(self.paths)
+            changed = set(p for p in snapshot.keys() | self._snapshot.keys()
+                if snapshot.get(p) != self._snapshot.get(p))
+            self._snapshot = snapshot
+            if changed:
+                return changed
+
+    def update(self, paths):
+        """
+        Change the watched paths. Paths which were already watched keep their
+        status, so changes made since the last check are still seen.
+
+        # Arguments
+
+        * paths (list<str>): The absolute paths of the files and directories
+          to watch.
+        """
+        kept = self.paths & set(paths)
+        self.paths = set(paths)
+        snapshot = dict((p, st) for p, st in self._snapshot.items()
+            if p in kept or os.path.dirname(p) in kept)
+        for p, st in self._scan(self.paths - kept).items():
+            snapshot.setdefault(p, st)
+        self._snapshot = snapshot
+
+    def close(self):
+        """
+        Stop watching.
+        """
+        pass
+
+class InotifyWatcher:
+    """
+    Watches paths for changes with inotify. The parent directory of each file
+    is watched so files replaced by editors are still seen.
+    """
+
+    # Event masks from <sys/inotify.h>
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+
+    # The time in seconds to wait for more events after the first one, so an
+    # editor saving several files results in a single change
+    SETTLE_TIME = 0.05
+
+    def __init__(self, paths):
+        """
+        Create a new inotify watcher.
+
+        # Arguments
+
+        * paths (list<str>): The absolute paths of the files and directories
+          to watch. The entries of a directory are watched too.
+
+        # Raises
+
+        (OSError): Inotify is not available.
+        """
+        import ctypes
+        import ctypes.util
+        name = ctypes.util.find_library("c")
+        if name is None:
+            raise OSError("libc not found")
+        libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not supported")
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "could not initialize inotify")
+        self._libc = libc
+        self.paths = set()
+        self._dirs = {}
+        self.update(paths)
+
+    def update(self, paths):
+        """
+        Change the watched paths. Directories which are already watched keep
+        their watches, so events which have not been read yet are kept.
+
+        # Arguments
+
+        * paths (list<str>): The absolute paths of the files and directories
+          to watch.
+        """
+        mask = (self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO
+            | self.IN_CREATE | self.IN_DELETE | self.IN_DELETE_SELF)
+        self.paths = set(paths)
+        for path in self.paths:
+            d = path if os.path.isdir(path) else os.path.dirname(path)
+            if d in self._dirs.values():
+                continue
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(d), mask)
+            if wd >= 0:
+                self._dirs[wd] = d
+
+    def wait(self):
+        """
+        Wait for changes.
+
+        # Returns
+
+        (set<str>): The paths that changed.
+        """
+        import select
+        import struct
+        header = struct.Struct("iIII")
+        while True:
+            changed = set()
+            timeout = None
+            while select.select([self.fd], [], [], timeout)[0]:
+                data = os.read(self.fd, 65536)
+                i = 0
+                while i < len(data):
+                    wd, _, _, length = header.unpack_from(data, i)
+                    i += header.size
+                    name = os.fsdecode(data[i:i + length].rstrip(b"\0"))
+                    i += length
+                    d = self._dirs.get(wd)
+                    if d is not None:
+                        changed.add(os.path.join(d, name) if name else d)
+                timeout = self.SETTLE_TIME
+            # Only report changes to watched paths and entries of watched
+            # directories
+            changed = set(p for p in changed
+                if p in self.paths or os.path.dirname(p) in self.paths)
+            if changed:
+                return changed
+
+    def close(self):
+        """
+        Stop watching.
+        """
+        os.close(self.fd)
+
+def create_watcher(paths, interval=Default.WATCH_INTERVAL):
+    """
+    Create a watcher, which uses inotify when it is available and falls back
+    to polling otherwise.
+
+    # Arguments
+
+    * paths (list<str>): The absolute paths to watch.
+    * interval (float): The polling interval in seconds.
+
+    # Returns
+
+    (InotifyWatcher|PollingWatcher): The watcher.
+    """
+    try:
+        return InotifyWatcher(paths)
+    except (OSError, AttributeError):
+        return PollingWatcher(paths, interval=interval)
+
+def changed_variables(old, new):
+    """
+    Find the variables whose values differ between two template
+    configurations. Snippets are compared by path, since they are not read.
+
+    # Arguments
+
+    * old (TemplatesConfig): The old template configuration.
+    * new (TemplatesConfig): The new template configuration.
+
+    # Returns
+
+    (set<str>): The names of the variables that changed.
+    """
+    changed = set()
+    for name in old.variables.keys() | new.variables.keys():
+        if old.variables.get(name) != new.variables.get(name):
+            changed.add(name)
+    for name in old.snippet_paths.keys() | new.snippet_paths.keys():
+        if old.snippet_paths.get(name) != new.snippet_paths.get(name):
+            changed.add(name)
+    return changed
+
+def watch(config_file, package_names, install=False, verbose=None,
+        dry_run=None, interval=Default.WATCH_INTERVAL, diff=False):
+    """
+    Build or install packages, then keep watching their sources, includes,
+    snippets and the configuration file, and rebuild only the outputs
+    affected by each change. The configuration and the compiled templates are
+    kept in memory between changes. This runs until interrupted.
+
+    # Arguments
+
+    * config_file (str): The path to the configuration file.
+    * packages_names (list<str>): A list of package names.
+    * install (bool): Install the packages instead of building them.
+    * verbose (bool): Enable verbose output.
+    * dry_run (bool): Enable dry run output.
+    * interval (float): The polling interval in seconds when inotify is not
+      available.
+    * diff (bool): Print a diff of the files that would change in a dry run.
+
+    # Returns
+
+    (Config): The most recently loaded configuration.
+    """
+    config = load_config(config_file, dry_run=dry_run)
+    config_path = os.path.abspath(config_file)
+
+    def run(config, tasks):
+        if dry_run:
+            plan_tasks(config, tasks, verbose=verbose, diff=diff,
+                context=context)
+            return
+        # Directories may be removed between runs
+        context.directories = set()
+        prepare_directories(config, [tasks], context)
+        context.manifest = Manifest(
+            os.path.join(config.build.dir, Default.BUILD_MANIFEST))
+        context.index = DependencyIndex(
+            os.path.join(config.build.dir, Default.BUILD_INDEX))
+        context.store = ObjectStore(
+            os.path.join(config.build.dir, Default.BUILD_STORE))
+        for task in tasks:
+            report_task(task, process_task(config, task, context), verbose,
+                dry_run)
+        context.manifest.save()
+        context.index.save()
+        context.store.save()
+
+    def flatten(config):
+        return [task for level in package_tasks(config, package_names,
+            build=not install, install=install) for task in level]
+
+    def watched(config, tasks):
+        templates = config.templates
+        inputs = set([config_path])
+        inputs.update(os.path.abspath(include.path) for include in templates.include)
+        if templates.snippets is not None:
+            inputs.add(os.path.abspath(templates.snippets))
+        return set(os.path.abspath(task[2]) for task in tasks), inputs
+
+    context = BuildContext()
+    tasks = flatten(config)
+    # The watcher is created before building, so changes made during a build
+    # are seen afterwards
+    sources, inputs = watched(config, tasks)
+    watcher = create_watcher(sources | inputs, interval=interval)
+    try:
+        run(config, tasks)
+        while True:
+            templates = config.templates
+            changed = watcher.wait()
+            variables = set()
+            reload = bool(changed & inputs)
+            if templates.snippets is not None:
+                snippets = os.path.abspath(templates.snippets)
+                for p in changed:
+                    if os.path.dirname(p) == snippets:
+                        reload = True
+                        variables.add(os.path.basename(p).split(".")[0])
+            affected = set(task[2] for task in tasks
+                if os.path.abspath(task[2]) in changed)
+            if reload:
+                try:
+                    new_config = load_config(config_file, dry_run=dry_run)
+                    new_tasks = flatten(new_config)
+                except (OSError, ValueError, DotsError) as ex:
+                    Fmt.status(Title.EXCEPTION, src=config_file, msg=str(ex), err=True)
+                    continue
+                variables |= changed_variables(templates, new_config.templates)
+                # Keep the compiled templates when the delimiters and the
+                # evaluator are the same
+                old_settings = (templates.begin, templates.end, templates.evaluator)
+                new_settings = (new_config.templates.begin,
+                    new_config.templates.end, new_config.templates.evaluator)
+                if old_settings == new_settings:
+                    new_config.templates.compiler = templates.compiler
+                # New files and files whose settings changed are affected too
+                old_files = dict(((task[0], task[2]), task[1].to_json())
+                    for task in tasks)
+                for task in new_tasks:
+                    if old_files.get((task[0], task[2])) != task[1].to_json():
+                        affected.add(task[2])
+                config, tasks = new_config, new_tasks
+            for src_path, names in context.dependencies.items():
+                if names & variables:
+                    affected.add(src_path)
+            Fmt.status(Title.WATCH, src=", ".join(sorted(os.path.relpath(p)
+                for p in changed)), verbose=verbose, dry_run=dry_run)
+            if reload:
+                sources, inputs = watched(config, tasks)
+                watcher.update(sources | inputs)
+            run(config, [task for task in tasks if task[2] in affected])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return config
+
+def synthetic_config(root, packages, files, variables, lines, density):
+    """
+    Generate a synthetic configuration and the files of its packages for
+    benchmarking. The output is deterministic for the same arguments.
+
+    # Arguments
+
+    * root (str): The directory to generate the files in.
+    * packages (int): The number of packages.
+    * files (int): The number of files per package.
+    * variables (int): The number of template variables.
+    * lines (int): The number of lines per file.
+    * density (float): The fraction of lines containing an expression.
+
+    # Returns
+
+    (dict): The JSON object representation of the configuration.
+    """
+    data = {
+        "build": { "dir": os.path.join(root, "build") },
+        "packages": {},
+        "templates": {
+            "snippets": os.path.join(root, "snippets"),
+            "variables": dict((f"var{k}", f"{(k * 2654435761) % 0xffffff:06x}")
+                for k in range(variables)),
+        },
+    }
+    every = round(1 / density) if density > 0 else 0
+    for i in range(packages):
+        name = f"package{i}"
+        # Each package depends on a couple of earlier packages
+        requires = sorted(set(f"package{j}" for j in (i - 1, i // 2) if 0 <= j < i))
+        package = { "files": {}, "requires": requires }
+        os.makedirs(os.path.join(root, name), exist_ok=True)
+        for j in range(files):
+            src_path = os.path.join(root, name, f"file{j}")
+            out = []
+            for n in range(lines):
+                k = (i * files * lines + j * lines + n) % max(variables, 1)
+                if variables and every and n % every == 0:
+                    if n % 3 == 0:
+                        out.append(f"value{n} = {{{{{{ int(_var{k}[0:2], 16) / 255 }}}}}}\n")
+                    else:
+                        out.append(f"value{n} = {{{{{{ _var{k} }}}}}}\n")
+                else:
+                    out.append(f"value{n} = literal text for line {n}\n")
+            with open(src_path, "w") as f:
+                f.writelines(out)
+            package["files"][src_path] = {
+                "dest": os.path.join(root, "dest", name, f"file{j}"),
+                "executable": j % 4 == 0,
+                "template": True,
+            }
+        data["packages"][name] = package
+    return data
+
+def benchmark(packages=50, files=10, variables=100, lines=50, density=0.5,
+        repeat=3):
+    """
+    Benchmark the phases of the build and install pipeline on a synthetic
+    configuration. The inputs are deterministic so results can be compared
+    across commits.
+
+    # Arguments
+
+    * packages (int): The number of packages.
+    * files (int): The number of files per package.
+    * variables (int): The number of template variables.
+    * lines (int): The number of lines per file.
+    * density (float): The fraction of lines containing an expression.
+    * repeat (int): The number of times each phase is run.
+
+    # Returns
+
+    (dict): The results, containing the parameters, the time and throughput
+    of each phase, and the peak resident set size.
+    """
+    import platform
+    import resource
+    import tempfile
+    import time
+
+    results = {}
+
+    def timed(name, ops, f):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            f()
+        seconds = time.perf_counter() - start
+        results[name] = {
+            "ops": ops * repeat,
+            "seconds": seconds,
+            "ops_per_sec": ops * repeat / seconds if seconds > 0 else None,
+        }
+
+    with tempfile.TemporaryDirectory(prefix="dots-bench-") as root:
+        data = synthetic_config(root, packages, files, variables, lines, density)
+        config = Config(data)
+        names = sorted(config.packages)
+        file_list = [(src_path, file_config)
+            for name in names
+            for src_path, file_config in config.packages[name].files.items()]
+        texts = []
+        for src_path, _ in file_list:
+            with open(src_path) as f:
+                texts.append(f.read())
+
+        timed("config", 1, lambda: Config(data))
+        timed("dependent_packages", 1, lambda: dependent_packages(config, names))
+        timed("fill_template", len(texts),
+            lambda: [fill_template(config.templates, text) for text in texts])
+        timed("process_file", len(file_list),
+            lambda: [process_file(config, file_config, src_path)
+                for src_path, file_config in file_list])
+        format_path = os.path.join(root, "dots.json")
+        timed("format_json", 1, lambda: format_json(config.to_json(), format_path))
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS reports bytes
+    if sys.platform == "darwin":
+        rss //= 1024
+    return {
+        "parameters": {
+            "packages": packages,
+            "files": files,
+            "variables": variables,
+            "lines": lines,
+            "density": density,
+            "repeat": repeat,
+        },
+        "python": platform.python_version(),
+        "phases": results,
+        "peak_rss_kb": rss,
+    }
+
+class ConfigCache:
+    """
+    A cache of a parsed and validated configuration, with its resolved
+    variables. The cache is keyed on the size, modification time and hash of
+    the configuration file, every include file, the snippets directory listing
+    and this program, so it is only used when none of them changed.
+
+    The cache is stored next to the configuration file rather than in the
+    build directory, since the build directory is only known after the
+    configuration is parsed.
+
+    The cache also records the hash of the configuration file the last time it
+    was formatted, so formatting can be skipped while the file is unchanged.
+    """
+
+    # Bumped whenever the format of the cache changes
+    VERSION = 3
+
+    def __init__(self, filename, dry_run=False):
+        """
+        Create a new configuration cache.
+
+        # Arguments
+
+        * filename (str): The path to the configuration file.
+        * dry_run (bool): Never write the cache file.
+        """
+        self.filename = filename
+        self.dry_run = dry_run
+        d, base = os.path.split(os.path.abspath(filename))
+        self.path = os.path.join(d, f".{base}.cache")
+        self.config = None
+        self.digest = None
+        self.formatted = None
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (stat.S_ISDIR(st.st_mode), st.st_size, st.st_mtime_ns)
+
+    @staticmethod
+    def _digest(path):
+        try:
+            if os.path.isdir(path):
+                return text_digest("\0".join(sorted(os.listdir(path))))
+            return file_digest(path)
+        except OSError:
+            return None
+
+    def _paths(self, config):
+        paths = [os.path.abspath(__file__), os.path.abspath(self.filename)]
+        templates = config.templates
+        paths.extend(os.path.abspath(include.path) for include in templates.include)
+        if templates.snippets is not None:
+            paths.append(os.path.abspath(templates.snippets))
+        return paths
+
+    def load(self):
+        """
+        Load the cached configuration.
+
+        # Returns
+
+        (Config|NoneType): The configuration, or `None` when the cache is
+        missing, invalid or out of date.
+        """
+        import pickle
+        try:
+            with open(self.path, "rb") as f:
+                version, key, config, formatted = pickle.load(f)
+        except Exception:
+            return None
+        if version != ConfigCache.VERSION:
+            return None
+        touched = False
+        for path, (st, digest) in key.items():
+            # The hash is only checked when the status changed
+            if self._stat(path) != st:
+                if self._digest(path) != digest:
+                    return None
+                touched = True
+        self.config = config
+        self.digest = key[os.path.abspath(self.filename)][1]
+        self.formatted = formatted
+        if touched:
+            # Store the new status so the hashes are not checked again
+            self.save(config)
+        return config
+
+    def save(self, config, formatted=None):
+        """
+        Cache a configuration. This may be done after the configuration was
+        used, since the `__getstate__` methods of the configuration, its
+        namespace and its template compiler drop the state built while filling
+        in templates. Nothing is written in a dry run.
+
+        # Arguments
+
+        * config (Config): The configuration.
+        * formatted (str|NoneType): The hash of the formatted configuration
+          file, or `None` to keep the hash that was loaded.
+        """
+        import pickle
+        key = dict((path, (self._stat(path), self._digest(path)))
+            for path in self._paths(config))
+        self.config = config
+        self.digest = key[os.path.abspath(self.filename)][1]
+        if formatted is not None:
+            self.formatted = formatted
+        if self.dry_run:
+            return
+        data = pickle.dumps((ConfigCache.VERSION, key, config, self.formatted))
+
+        def fill(tmp_path):
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+
+        try:
+            replace_file(self.path, 0o666 & ~UMASK, fill)
+        except OSError:
+            pass
+
+    def is_formatted(self):
+        """
+        Check whether the configuration file is known to be formatted, without
+        reading it.
+
+        # Returns
+
+        (bool): True if the file did not change since it was last formatted.
+        """
+        return self.digest is not None and self.digest == self.formatted
+
+def format_config(config, cache):
+    """
+    Format a configuration file, unless it did not change since it was last
+    formatted.
+
+    # Arguments
+
+    * config (Config): The configuration.
+    * cache (ConfigCache): The cache of the configuration file, which the
+      configuration was loaded with.
+
+    # Returns
+
+    (bool): True if the file was modified, false otherwise.
+    """
+    if cache.is_formatted():
+        return False
+    written = format_json(config.to_json(), filename=cache.filename)
+    # Storing the hash also refreshes the status of the file in the cache, so
+    # the configuration is not parsed again after it was rewritten
+    cache.save(config, formatted=file_digest(cache.filename))
+    return written
+
+def load_config(filename, cache=None, dry_run=False):
+    """
+    Load a configuration file, using the cached configuration when it is up
+    to date.
+
+    # Arguments
+
+    * filename (str): The path to the configuration file.
+    * cache (ConfigCache|NoneType): The cache to use, or `None` to create one.
+    * dry_run (bool): Do not write the cache when one is created.
+
+    # Returns
+
+    (Config): The configuration.
+    """
+    import json
+    if cache is None:
+        cache = ConfigCache(filename, dry_run=dry_run)
+    with PROFILER.phase("config cache", file=filename):
+        config = cache.load()
+    if config is not None:
+        return config
+    with PROFILER.phase("config", file=filename):
+        with open(filename) as f:
+            try:
+                data = json.load(f)
+            except json.JSONDecodeError as ex:
+                raise JSONError(str(ex)) from ex
+            PROFILER.count(read=f.tell())
+            config = Config(data)
+    cache.save(config)
+    return config
+
+def run(args):
+    """
+    Run a subcommand.
+
+    # Arguments
+
+    * args (Namespace): The parsed arguments.
+    """
+    import json
+    if args.subcommand == "bench":
+        results = benchmark(packages=args.packages, files=args.files,
+            variables=args.variables, lines=args.lines, density=args.density,
+            repeat=args.repeat)
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+
+    cache = ConfigCache(args.config_file, dry_run=args.dry_run)
+    if args.subcommand == "watch":
+        config = watch(args.config_file, args.packages, install=args.install,
+            verbose=args.verbose, dry_run=args.dry_run, interval=args.interval,
+            diff=args.diff)
+    else:
+        config = load_config(args.config_file, cache)
+
+    run_format = False
+
+    if args.subcommand == "build":
+        traverse_packages(config, args.packages, build=True, install=False,
+                 verbose=args.verbose, dry_run=args.dry_run,
+                 jobs=args.jobs, force=args.force,
+                 changed_vars=args.changed_vars, diff=args.diff,
+                 engine=args.engine)
+    elif args.subcommand == "format":
+        run_format = True
+    elif args.subcommand == "gc":
+        collect_store(config, max_size=args.max_size, max_age=args.max_age,
+            verbose=args.verbose, dry_run=args.dry_run)
+    elif args.subcommand == "watch":
+        pass
+    elif args.subcommand == "install":
+        traverse_packages(config, args.packages, build=False, install=True,
+                 verbose=args.verbose, dry_run=args.dry_run,
+                 jobs=args.jobs, force=args.force,
+                 changed_vars=args.changed_vars, diff=args.diff,
+                 engine=args.engine)
+    else:
+        # This will never be hit
+        Fmt.status(Title.EXCEPTION, src=args.subcommand,
+            msg="Command not specified", err=True)
+        sys.exit(1)
+
+    if run_format or config.build.format:
+        written = False
+        if not args.dry_run:
+            with PROFILER.phase("format", file=args.config_file):
+                written = format_config(config, cache)
+        if args.dry_run or written:
+            Fmt.status(Title.FORMAT, src=args.config_file,
+                verbose=args.verbose, dry_run=args.dry_run)
+
+def write_profile(filename, profile=None):
+    """
+    Print a summary of the recorded phases and write the profile to a file.
+
+    # Arguments
+
+    * filename (str): The path to the profile output. When it ends with
+      `.prof` the cProfile statistics are written, otherwise a Chrome trace.
+    * profile (cProfile.Profile): The cProfile profiler, if one was used.
+    """
+    import json
+    summary = PROFILER.summary()
+    for name, phase in sorted(summary["phases"].items()):
+        Fmt.status(Title.PROFILE, src=name,
+            msg=f"{phase['count']} calls, {phase['wall']:.6f}s wall, "
+                f"{phase['cpu']:.6f}s cpu",
+            verbose=True)
+    Fmt.status(Title.PROFILE, src="io",
+        msg=f"{summary['bytes_read']} bytes read, "
+            f"{summary['bytes_written']} bytes written",
+        verbose=True)
+    if profile is not None:
+        profile.dump_stats(filename)
+    else:
+        with open(filename, "w") as f:
+            json.dump(PROFILER.trace_events(), f)
+
+def startup_time(budget=Default.STARTUP_BUDGET):
+    """
+    Measure the cost of starting the program by importing it in a fresh
+    interpreter, and report the modules it imports.
+
+    # Arguments
+
+    * budget (float): The maximum time in seconds that importing the program
+      should take.
+
+    # Returns
+
+    (bool): True if the import time is within the budget.
+    """
+    import subprocess
+    d = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [d, env.get("PYTHONPATH")]))
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    name = os.path.splitext(os.path.basename(__file__))[0]
+    cmd = [sys.executable, "-X", "importtime", "-c", f"import {name}"]
+    # The first import writes the bytecode cache, and the second one is timed
+    for _ in range(2):
+        result = subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise DotsError(f"could not import {name}: {result.stderr.strip()}")
+    # Lines look like "import time: self [us] | cumulative | imported package",
+    # where nesting is shown by indentation and modules are listed after the
+    # modules they import
+    modules = []
+    pending = []
+    total = 0
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) != 3 or not fields[0].startswith("import time:"):
+            continue
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            continue
+        module = fields[2].rstrip()
+        depth = (len(module) - len(module.lstrip())) // 2
+        if depth == 1:
+            pending.append((module.strip(), cumulative))
+        elif depth == 0:
+            if module.strip() == name:
+                total = cumulative
+                modules = pending
+            pending = []
+    for module, cumulative in sorted(modules, key=lambda m: -m[1]):
+        Fmt.status(Title.STARTUP, src=module,
+            msg=f"{cumulative / 1000:.2f} ms", verbose=True)
+    ok = total / 1e6 <= budget
+    Fmt.status(Title.STARTUP, src=name,
+        msg=f"{total / 1000:.2f} ms (budget {budget * 1000:.2f} ms)",
+        err=not ok, verbose=True)
+    return ok
+
+def main():
+    args = parse_args()
+
+    if args.profile is None:
+        run(args)
+        return
+
+    PROFILER.enable()
+    profile = None
+    if args.profile.endswith(".prof"):
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        run(args)
+    finally:
+        if profile is not None:
+            profile.disable()
+        write_profile(args.profile, profile)
+
+def entry():
+    """
+    The entry point of the program, which reports errors.
+    """
+    # Fast path which does not need the argument parser
+    if "--startup-time" in sys.argv[1:]:
+        sys.exit(0 if startup_time() else 1)
+    try:
+        main()
+    except JSONError as ex:
+        Fmt.status(Title.EXCEPTION, src="JSON Validation", msg=str(ex), err=True)
+    except FileNotFoundError as ex:
+        Fmt.status(Title.EXCEPTION, msg=str(ex), err=True)
+    except DotsError as ex:
+        Fmt.status(Title.EXCEPTION, msg=str(ex), err=True)
+
+if __name__ == "__main__":
+    entry()